@@ -0,0 +1,5 @@
+#!/bin/bash
+
+export PYTHONPATH=$PYTHONPATH:.
+
+poetry run python benchmarks/run.py "$@"
@@ -0,0 +1,59 @@
+import io
+import time
+from contextlib import redirect_stdout
+
+from promptwithoptions import compile_prompt, promptwithoptions, run_form
+
+PROMPT_COUNT = 2000
+
+
+def make_specs():
+    return [
+        {
+            "name": f"field{i}",
+            "prompt": f"Field {i}",
+            "options": tuple(f"value{j}" for j in range(20)),
+            "default": "value3",
+        }
+        for i in range(PROMPT_COUNT)
+    ]
+
+
+def measure(label, run):
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+    print(f"{label:<40} {PROMPT_COUNT / elapsed:>10.0f} prompts/s")
+
+
+def main():
+    specs = make_specs()
+    answers = {f"field{i}": f"value{i % 20}" for i in range(PROMPT_COUNT)}
+    compiled_specs = [
+        compile_prompt(**{k: v for k, v in spec.items() if k != "name"})
+        for spec in specs
+    ]
+    measure(
+        "promptwithoptions(no_interaction=True)",
+        lambda: [
+            promptwithoptions(
+                spec["prompt"],
+                options=spec["options"],
+                default=spec["default"],
+                no_interaction=True,
+            )
+            for spec in specs
+        ],
+    )
+    measure("run_form", lambda: run_form(specs, answers))
+    measure("run_form(quiet=True)", lambda: run_form(specs, answers, quiet=True))
+    prompt_answers = {f"Field {i}": f"value{i % 20}" for i in range(PROMPT_COUNT)}
+    measure(
+        "run_form(compiled specs, quiet=True)",
+        lambda: run_form(compiled_specs, prompt_answers, quiet=True),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+from promptwithoptions.server import serve, open_connection
+
+SESSION_COUNT = 300
+QUESTIONS = (
+    ("Environment", ("dev", "qa", "prod")),
+    ("Region", tuple(f"region-{i}" for i in range(50))),
+    ("Replicas", None),
+)
+
+
+async def handler(session):
+    for prompt, options in QUESTIONS:
+        await session.ask(prompt, options=options)
+
+
+async def read_until(reader, marker):
+    data = b""
+    while marker not in data:
+        chunk = await reader.read(65536)
+        if not chunk:
+            raise EOFError
+        data += chunk
+
+
+async def simulate_operator(path, latencies):
+    reader, writer = await open_connection(path=path)
+    await read_until(reader, b"?* ")
+    answers = ("prod", "17", "3")
+    for index, answer in enumerate(answers):
+        start = time.perf_counter()
+        writer.write(f"{answer}\n".encode())
+        if index + 1 < len(answers):
+            await read_until(reader, b"?* ")
+        else:
+            await reader.read()
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def main():
+    path = os.path.join(tempfile.mkdtemp(), "prompt.sock")
+    server = await serve(handler, path=path, backlog=SESSION_COUNT)
+    latencies = list()
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(simulate_operator(path, latencies) for _ in range(SESSION_COUNT))
+    )
+    elapsed = time.perf_counter() - start
+    server.close()
+    await server.wait_closed()
+    latencies.sort()
+    print(
+        f"{SESSION_COUNT} concurrent sessions, "
+        f"{len(latencies)} answers in {elapsed:.2f} s"
+    )
+    for label, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        print(f"{label}: {percentile(latencies, fraction) * 1000:.2f} ms")
+    print(f"max: {latencies[-1] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        SESSION_COUNT = int(sys.argv[1])
+    asyncio.run(main())
@@ -0,0 +1,44 @@
+import sys
+import time
+
+from promptwithoptions.promptwithoptions import validate_arguments
+
+SIZES = (1000, 2000, 4000, 8000)
+# doubling the input should roughly double the time, allow generous noise
+MAX_GROWTH_RATIO = 3.0
+
+
+def time_validate(option_count, repeat=5):
+    options = tuple((f"key{i}", f"value {i}") for i in range(option_count))
+    default = tuple(f"key{i}" for i in range(0, option_count, 10))
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        validate_arguments(
+            options=options, data_type=str, default=default, allow_multiple=True
+        )
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    timings = [(size, time_validate(size)) for size in SIZES]
+    failed = False
+    previous = None
+    for size, elapsed in timings:
+        ratio = "" if previous is None else f"  x{elapsed / previous:.2f}"
+        print(
+            f"{size:>8} options, {size // 10:>6} defaults: "
+            f"{elapsed * 1000:8.2f} ms{ratio}"
+        )
+        if previous is not None and elapsed / previous > MAX_GROWTH_RATIO:
+            failed = True
+        previous = elapsed
+    if failed:
+        print("validate_arguments does not scale linearly")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
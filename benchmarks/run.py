@@ -0,0 +1,595 @@
+import os
+import sys
+import gc
+import json
+import shlex
+import subprocess
+import sqlite3
+import tempfile
+import timeit
+import tracemalloc
+import atexit
+import argparse
+import platform
+
+from promptwithoptions import (
+    CompactOptionSet,
+    FileOptionSet,
+    MemoryPromptIO,
+    OptionProvider,
+    SessionRecorder,
+    SessionReplayer,
+    compile_prompt,
+    promptwithoptions,
+)
+from promptwithoptions.promptwithoptions import (
+    CONVERTED_VALUES,
+    OptionSet,
+    compile_options,
+    get_formatted_prompt,
+    get_option,
+    normalise_options,
+    print_formatted_options,
+    split_escaped_comma_separated_string,
+    validate_arguments,
+)
+
+DEFAULT_SIZES = (10, 1000, 100000, 1000000)
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# the linear legacy lookup is only measured where it finishes in reasonable time
+LINEAR_LOOKUP_MAX_SIZE = 100000
+# bytes per option hardly change with the size and tracing is slow
+MEMORY_MAX_SIZE = 100000
+# every question starts an interpreter in one-shot mode
+CLI_ONE_SHOT_MAX_SIZE = 100
+CLI_COPROCESS_MAX_SIZE = 10000
+
+CASES = list()
+MEMORY_CASES = list()
+
+
+def case(name, max_size=None):
+    def register(setup):
+        CASES.append((name, setup, max_size))
+        return setup
+
+    return register
+
+
+def memory_case(name, max_size=None):
+    # build() is traced with tracemalloc, the result is kept alive until the
+    # allocated size is read
+    def register(build):
+        MEMORY_CASES.append((name, build, max_size))
+        return build
+
+    return register
+
+
+def make_options(size):
+    return [(f"key{i}", f"value {i}") for i in range(size)]
+
+
+def make_multi_answer(size, count=100):
+    return ",".join(f"key{i}" for i in range(0, size, max(1, size // count)))
+
+
+@case("normalise_options")
+def bench_normalise_options(size):
+    options = make_options(size)
+    return lambda: normalise_options(options)
+
+
+@case("compile_options")
+def bench_compile_options(size):
+    options = make_options(size)
+    return lambda: compile_options(options)
+
+
+@case("compile_options_compact")
+def bench_compile_options_compact(size):
+    options = make_options(size)
+    return lambda: CompactOptionSet(options)
+
+
+@case("get_option_compact")
+def bench_get_option_compact(size):
+    option_set = CompactOptionSet(make_options(size))
+    last_key = f"key{size - 1}"
+    return lambda: get_option(option_set, last_key)
+
+
+@case("get_option")
+def bench_get_option(size):
+    option_set = compile_options(make_options(size))
+    last_key = f"key{size - 1}"
+    return lambda: get_option(option_set, last_key)
+
+
+def make_options_file(size):
+    options_file = tempfile.NamedTemporaryFile(
+        "w", suffix=".csv", delete=False, newline=""
+    )
+    with options_file:
+        options_file.writelines(f"key{i},value {i}\n" for i in range(size))
+    atexit.register(os.remove, options_file.name)
+    atexit.register(os.remove, f"{options_file.name}.pwoidx")
+    # builds the index cached next to the file
+    return FileOptionSet(options_file.name)
+
+
+@case("file_options_reopen")
+def bench_file_options_reopen(size):
+    path = make_options_file(size).path
+    return lambda: FileOptionSet(path)
+
+
+@case("get_option_file")
+def bench_get_option_file(size):
+    option_set = make_options_file(size)
+    last_key = f"key{size - 1}"
+    return lambda: get_option(option_set, last_key)
+
+
+@case("get_option_linear", max_size=LINEAR_LOOKUP_MAX_SIZE)
+def bench_get_option_linear(size):
+    options = normalise_options(make_options(size))
+    last_key = f"key{size - 1}"
+    return lambda: get_option(options, last_key)
+
+
+@case("validate_arguments")
+def bench_validate_arguments(size):
+    options = make_options(size)
+    default = make_multi_answer(size)
+    return lambda: validate_arguments(
+        options=options, data_type=str, default=default, allow_multiple=True
+    )
+
+
+def parse_host_id(value):
+    # stands for the structured id parsers used as data_type
+    site, rack, number = value.split("-")
+    if not site.isalpha() or len(rack) != 3:
+        raise ValueError(value)
+    return site, int(rack), int(number)
+
+
+def make_host_options(size):
+    return [f"par-{i % 997:03d}-{i}" for i in range(size)]
+
+
+@case("validate_data_type")
+def bench_validate_data_type(size):
+    options = make_host_options(size)
+
+    def run():
+        CONVERTED_VALUES.clear()
+        validate_arguments(options=options, data_type=parse_host_id)
+
+    return run
+
+
+@case("validate_data_type_processes", max_size=LINEAR_LOOKUP_MAX_SIZE)
+def bench_validate_data_type_processes(size):
+    options = make_host_options(size)
+
+    def run():
+        CONVERTED_VALUES.clear()
+        validate_arguments(
+            options=options, data_type=parse_host_id, option_validation="processes"
+        )
+
+    return run
+
+
+@case("validate_data_type_memoised")
+def bench_validate_data_type_memoised(size):
+    options = make_host_options(size)
+    validate_arguments(options=options, data_type=parse_host_id)
+    return lambda: validate_arguments(options=options, data_type=parse_host_id)
+
+
+@case("validate_data_type_lazy")
+def bench_validate_data_type_lazy(size):
+    options = make_host_options(size)
+    return lambda: validate_arguments(
+        options=options, data_type=parse_host_id, option_validation="lazy"
+    )
+
+
+@case("get_formatted_prompt")
+def bench_get_formatted_prompt(size):
+    option_set = compile_options(make_options(size))
+    default = split_escaped_comma_separated_string(make_multi_answer(size))
+    return lambda: get_formatted_prompt(
+        "Hosts", option_set, None, default, None, True, None, None, None, None, None
+    )
+
+
+@case("get_formatted_prompt_bool")
+def bench_get_formatted_prompt_bool(size):
+    default = ",".join("y" if i % 2 else "n" for i in range(min(size, 100)))
+    return lambda: get_formatted_prompt(
+        "Flags", None, bool, default, None, True, None, None, None, None, None
+    )
+
+
+@case("print_formatted_options")
+def bench_print_formatted_options(size):
+    option_set = compile_options(make_options(size))
+
+    def run():
+        prompt_io = MemoryPromptIO()
+        print_formatted_options(option_set, prompt_io=prompt_io)
+        prompt_io.flush()
+
+    return run
+
+
+def make_split_text(size):
+    return ",".join(
+        f'"item {i}, quoted"' if i % 10 == 0 else f"item{i}" for i in range(size)
+    )
+
+
+def shlex_split(the_string):
+    # the shlex based splitting the tokenizer replaced, kept for comparison
+    splitter = shlex.shlex(the_string, posix=True)
+    splitter.whitespace = ","
+    splitter.whitespace_split = True
+    return tuple(s.strip() for s in splitter)
+
+
+@case("split_escaped_comma_separated_string")
+def bench_split(size):
+    text = make_split_text(size)
+    return lambda: split_escaped_comma_separated_string(text)
+
+
+@case("split_escaped_comma_separated_string_plain")
+def bench_split_plain(size):
+    text = ",".join(f"item{i}" for i in range(size))
+    return lambda: split_escaped_comma_separated_string(text)
+
+
+@case("split_shlex_reference", max_size=LINEAR_LOOKUP_MAX_SIZE)
+def bench_split_shlex(size):
+    text = make_split_text(size)
+    return lambda: shlex_split(text)
+
+
+@case("promptwithoptions_single")
+def bench_prompt_single(size):
+    options = make_options(size)
+    answer = f"key{size - 1}\n"
+    return lambda: promptwithoptions(
+        "Host", options=options, page_size=20, prompt_io=MemoryPromptIO(answer)
+    )
+
+
+@case("promptwithoptions_listed", max_size=LINEAR_LOOKUP_MAX_SIZE)
+def bench_prompt_listed(size):
+    # no paging, the whole option list is printed on every call
+    options = make_options(size)
+    answer = f"key{size - 1}\n"
+    return lambda: promptwithoptions(
+        "Host", options=options, default="key0", prompt_io=MemoryPromptIO(answer)
+    )
+
+
+@case("promptwithoptions_multiple")
+def bench_prompt_multiple(size):
+    options = make_options(size)
+    answer = make_multi_answer(size) + "\n"
+    return lambda: promptwithoptions(
+        "Hosts",
+        options=options,
+        allow_multiple=True,
+        page_size=20,
+        prompt_io=MemoryPromptIO(answer),
+    )
+
+
+@case("promptwithoptions_bool")
+def bench_prompt_bool(size):
+    answer = ",".join("y" if i % 2 else "n" for i in range(size)) + "\n"
+    return lambda: promptwithoptions(
+        "Flags",
+        data_type=bool,
+        allow_multiple=True,
+        allow_repetitive=True,
+        prompt_io=MemoryPromptIO(answer),
+    )
+
+
+def make_inventory_query(size):
+    # stands for the local queries options are often taken from
+    connection = sqlite3.connect(":memory:", check_same_thread=False)
+    connection.execute("create table hosts (name text, label text)")
+    connection.executemany(
+        "insert into hosts values (?, ?)",
+        ((f"key{i}", f"value {i}") for i in range(size)),
+    )
+    return lambda: connection.execute("select name, label from hosts").fetchall()
+
+
+@case("promptwithoptions_provider")
+def bench_prompt_provider(size):
+    query = make_inventory_query(size)
+    answer = f"key{size - 1}\n"
+    return lambda: promptwithoptions(
+        "Host", options=query(), page_size=20, prompt_io=MemoryPromptIO(answer)
+    )
+
+
+@case("promptwithoptions_provider_cached")
+def bench_prompt_provider_cached(size):
+    provider = OptionProvider(make_inventory_query(size), ttl=60)
+    answer = f"key{size - 1}\n"
+    return lambda: promptwithoptions(
+        "Host", options=provider, page_size=20, prompt_io=MemoryPromptIO(answer)
+    )
+
+
+CLI_COMMAND = (sys.executable, "-m", "promptwithoptions", "--tty", os.devnull)
+CLI_ENV = dict(
+    os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+CLI_REQUEST = {
+    "prompt": "Colour",
+    "options": ["red", "green", "blue"],
+    "default": "green",
+    "no_interaction": True,
+}
+
+
+@case("cli_one_shot", max_size=CLI_ONE_SHOT_MAX_SIZE)
+def bench_cli_one_shot(size):
+    # size is the number of questions, each asked by its own process
+    command = CLI_COMMAND + ("--json", json.dumps(CLI_REQUEST))
+
+    def run():
+        for _ in range(size):
+            subprocess.run(command, env=CLI_ENV, stdout=subprocess.PIPE, check=True)
+
+    return run
+
+
+@case("cli_coprocess", max_size=CLI_COPROCESS_MAX_SIZE)
+def bench_cli_coprocess(size):
+    # one process answering all questions, started within the measurement
+    request = json.dumps(CLI_REQUEST) + "\n"
+
+    def run():
+        coprocess = subprocess.Popen(
+            CLI_COMMAND + ("--coprocess",),
+            env=CLI_ENV,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        with coprocess:
+            for _ in range(size):
+                coprocess.stdin.write(request)
+                coprocess.stdin.flush()
+                coprocess.stdout.readline()
+            coprocess.stdin.close()
+
+    return run
+
+
+@memory_case("option_set", max_size=MEMORY_MAX_SIZE)
+def memory_option_set(options):
+    return OptionSet(normalise_options(options))
+
+
+@memory_case("file_option_set", max_size=MEMORY_MAX_SIZE)
+def memory_file_option_set(options):
+    # the index is cached by then, what stays in memory once reopened
+    options_file = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False)
+    with options_file:
+        options_file.writelines(",".join(option) + "\n" for option in options)
+    try:
+        FileOptionSet(options_file.name)
+        tracemalloc.clear_traces()
+        return FileOptionSet(options_file.name)
+    finally:
+        os.remove(options_file.name)
+        os.remove(f"{options_file.name}.pwoidx")
+
+
+@memory_case("compact_option_set", max_size=MEMORY_MAX_SIZE)
+def memory_compact_option_set(options):
+    return CompactOptionSet(options)
+
+
+@case("replay_session", max_size=LINEAR_LOOKUP_MAX_SIZE)
+def bench_replay_session(size):
+    # size recorded prompts of a setup script, replayed from the log
+    options = [f"region-{i}" for i in range(20)]
+    specs = [
+        compile_prompt(f"Region {i}", options=options, default="region-3")
+        for i in range(size)
+    ]
+    log_file = tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False)
+    log_file.close()
+    atexit.register(os.remove, log_file.name)
+    with SessionRecorder(log_file.name) as recorder:
+        for i, spec in enumerate(specs):
+            spec.session_log = recorder
+            spec.prompt_io = MemoryPromptIO(f"region-{i % 20}\n")
+            spec.ask()
+
+    def run():
+        replayer = SessionReplayer(log_file.name)
+        for spec in specs:
+            spec.session_log = replayer
+            spec.ask()
+
+    return run
+
+
+def measure(run, repeat):
+    timer = timeit.Timer(run)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run_cases(sizes, name_filter=None, repeat=3):
+    results = dict()
+    for name, setup, max_size in CASES:
+        if name_filter is not None and name_filter not in name:
+            continue
+        for size in sizes:
+            if max_size is not None and size > max_size:
+                continue
+            key = f"{name}[{size}]"
+            results[key] = measure(setup(size), repeat)
+            print(f"{key:<50} {format_seconds(results[key]):>12}", flush=True)
+    return results
+
+
+def measure_memory(build, size):
+    # the options are generated while tracing, so that their strings count
+    # towards the option set as they would when read from a file; full
+    # collections empty the interpreter's free lists, whose blocks would
+    # otherwise count or not depending on the cases run before
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        built = build((f"key{i}", f"value {i}") for i in range(size))
+        gc.collect()
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del built
+    return allocated / size
+
+
+def run_memory_cases(sizes, name_filter=None):
+    results = dict()
+    for name, build, max_size in MEMORY_CASES:
+        if name_filter is not None and name_filter not in name:
+            continue
+        for size in sizes:
+            if max_size is not None and size > max_size:
+                continue
+            key = f"{name}[{size}]"
+            results[key] = measure_memory(build, size)
+            print(f"{key:<50} {format_bytes(results[key]):>12}", flush=True)
+    return results
+
+
+def format_bytes(size):
+    return f"{size:.1f} B/option"
+
+
+def format_seconds(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e3), ("us", 1e6)):
+        if seconds * scale >= 1:
+            return f"{seconds * scale:.2f} {unit}"
+    return f"{seconds * 1e9:.0f} ns"
+
+
+def calibration_workload():
+    # plain interpreter work of the kind the cases do: strings, splits, dicts
+    index = dict()
+    for i in range(20000):
+        key, _, value = f"key{i},value {i}".partition(",")
+        index[key] = value.upper()
+    return len(index)
+
+
+def calibrate(repeat=5):
+    # the speed of the machine at the moment, to compare timings across
+    # machines and load
+    return measure(calibration_workload, repeat)
+
+
+def compare(results, baseline, tolerance, format_value=format_seconds, scale=1.0):
+    regressions = list()
+    for key, value in results.items():
+        baseline_value = baseline.get(key)
+        if baseline_value is not None:
+            baseline_value *= scale
+        if baseline_value is not None and value > baseline_value * tolerance:
+            regressions.append((key, baseline_value, value))
+    for key, baseline_value, value in regressions:
+        print(
+            f"REGRESSION {key}: {format_value(baseline_value)}"
+            f" -> {format_value(value)}"
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="promptwithoptions benchmarks")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="comma-separated option counts",
+    )
+    parser.add_argument("--filter", help="only run cases containing this text")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the new baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.5,
+        help="fail if a case is slower than baseline times this factor",
+    )
+    args = parser.parse_args(argv)
+    sizes = tuple(int(size) for size in args.sizes.split(","))
+    calibration_before = calibrate()
+    results = run_cases(sizes, args.filter, args.repeat)
+    # the load may change during a long run
+    calibration = (calibration_before + calibrate()) / 2
+    print(f"{'calibration':<50} {format_seconds(calibration):>12}")
+    memory_results = run_memory_cases(sizes, args.filter)
+    baseline = dict()
+    memory_baseline = dict()
+    baseline_calibration = calibration
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            stored_baseline = json.load(baseline_file)
+        baseline = stored_baseline["results"]
+        memory_baseline = stored_baseline.get("memory", dict())
+        baseline_calibration = stored_baseline.get("calibration", calibration)
+    # timings are compared relative to the calibration workload, so that a
+    # slower or busier machine does not show as a regression
+    scale = calibration / baseline_calibration
+    if args.save_baseline:
+        baseline.update((key, value / scale) for key, value in results.items())
+        memory_baseline.update(memory_results)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "calibration": baseline_calibration,
+                    "results": baseline,
+                    "memory": memory_baseline,
+                },
+                baseline_file,
+                indent=2,
+                sort_keys=True,
+            )
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, run with --save-baseline first")
+        return 0
+    regressions = compare(results, baseline, args.tolerance, scale=scale)
+    regressions += compare(
+        memory_results, memory_baseline, args.tolerance, format_bytes
+    )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,23 @@
 from .promptwithoptions import (
     set_prompt_defaults,
     reset_prompt_defaults,
+    prompt_defaults,
     promptwithoptions,
+    async_promptwithoptions,
+    compile_prompt,
+    PromptSpec,
+    OptionSet,
+    CompactOptionSet,
+    FileOptionSet,
+    OptionProvider,
+    cached_options,
+    PromptIO,
+    TTYPromptIO,
+    MemoryPromptIO,
+    PromptMetrics,
+    JsonLinesMetricsExporter,
+    AnswerHistory,
+    SessionRecorder,
+    SessionReplayer,
+    run_form,
 )
@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import argparse
+from contextlib import contextmanager, nullcontext
+
+from .promptwithoptions import (
+    ARGUMENT_NAMES,
+    PromptIO,
+    TTYPromptIO,
+    readline,
+    AnswerHistory,
+    promptwithoptions,
+    get_json_value,
+    split_escaped_comma_separated_string,
+)
+
+# data types can only be given by name on the command line and in requests
+DATA_TYPES = {"str": str, "int": int, "float": float, "bool": bool}
+# arguments taking objects that a request cannot describe
+OBJECT_ARGUMENTS = ("prompt_io", "on_metrics", "session_log")
+FLAG_ARGUMENTS = (
+    "allow_empty",
+    "allow_multiple",
+    "allow_repetitive",
+    "show_confirmation",
+    "hide_key",
+    "hide_questionmark",
+    "hide_mandatory_sign",
+    "hide_multiple_choice_sign",
+    "no_interaction",
+    "allow_search",
+    "allow_completion",
+    "return_converted",
+)
+ARGUMENT_TYPES = {"page_size": int, "timeout": float}
+HISTORIES = dict()
+
+EXIT_ERROR = 1
+EXIT_TIMEOUT = 124
+EXIT_INTERRUPTED = 130
+
+
+def get_history(path):
+    # one history per file, so that a coprocess does not read it every time
+    history = HISTORIES.get(path)
+    if history is None:
+        history = AnswerHistory(path)
+        HISTORIES[path] = history
+    return history
+
+
+def load_request(request):
+    if not isinstance(request, dict):
+        raise TypeError("request: JSON object expected")
+    arguments = dict()
+    for name, value in request.items():
+        if name == "id":
+            continue
+        if name not in ARGUMENT_NAMES or name in OBJECT_ARGUMENTS:
+            raise TypeError(f"{name}: unknown argument")
+        if name == "data_type" and value is not None:
+            if value not in DATA_TYPES:
+                raise TypeError(
+                    "data_type: one of " + ", ".join(DATA_TYPES) + " expected"
+                )
+            value = DATA_TYPES[value]
+        elif name == "options" and isinstance(value, list):
+            # key and value pairs come as lists
+            value = [tuple(o) if isinstance(o, list) else o for o in value]
+        elif name == "history" and value is not None:
+            if not isinstance(value, str):
+                raise TypeError("history: path expected")
+            value = get_history(value)
+        arguments[name] = value
+    return arguments
+
+
+@contextmanager
+def terminal_prompt_io(terminal_fd):
+    # the human is asked on the terminal, the script's stdin and stdout are
+    # only borrowed while a terminal stands in for them
+    if readline is None or not os.isatty(terminal_fd):
+        with open(terminal_fd, closefd=False) as reader, open(
+            terminal_fd, "w", closefd=False
+        ) as writer:
+            yield PromptIO(reader, writer)
+        return
+    # input() only edits lines and completes with readline when it reads the
+    # process's own stdin and writes its stdout
+    sys.stdout.flush()
+    saved_streams = (sys.stdin, sys.stdout)
+    saved_fds = (os.dup(0), os.dup(1))
+    os.dup2(terminal_fd, 0)
+    os.dup2(terminal_fd, 1)
+    sys.stdin = open(0, closefd=False)
+    sys.stdout = open(1, "w", closefd=False)
+    try:
+        yield TTYPromptIO()
+    finally:
+        sys.stdout.flush()
+        for fd, saved_fd in enumerate(saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        sys.stdin, sys.stdout = saved_streams
+
+
+def format_answer(answer):
+    if isinstance(answer, (list, tuple)):
+        return "".join(f"{part}\n" for part in answer)
+    return f"{answer}\n"
+
+
+def ask(arguments, prompt_io):
+    arguments = dict(arguments)
+    arguments["prompt_io"] = prompt_io
+    return promptwithoptions(**arguments)
+
+
+def serve_requests(reader, writer, prompt_io):
+    # one JSON request per line, answered in order by one JSON line
+    while True:
+        line = reader.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        request_id = None
+        try:
+            request = json.loads(line)
+            if isinstance(request, dict):
+                request_id = request.get("id")
+            answer = ask(load_request(request), prompt_io)
+            response = {"answer": get_json_value(answer)}
+        except ValueError as e:
+            response = {"error": str(e) or "invalid response", "type": "ValueError"}
+        except TypeError as e:
+            response = {"error": str(e), "type": "TypeError"}
+        except TimeoutError:
+            response = {"error": "timed out", "type": "TimeoutError"}
+        except EOFError:
+            response = {"error": "end of input", "type": "EOFError"}
+        except KeyboardInterrupt:
+            prompt_io.write_line()
+            prompt_io.flush()
+            response = {"error": "interrupted", "type": "KeyboardInterrupt"}
+        response["id"] = request_id
+        writer.write(json.dumps(response) + "\n")
+        writer.flush()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m promptwithoptions",
+        description=(
+            "Ask a question on the terminal and print the answer, or answer "
+            "JSON prompt requests line by line with --coprocess"
+        ),
+    )
+    parser.add_argument("prompt", nargs="?")
+    parser.add_argument(
+        "--options", help="comma separated options, quoted like the answers"
+    )
+    parser.add_argument("--data-type", choices=tuple(DATA_TYPES))
+    parser.add_argument(
+        "--json",
+        dest="request",
+        help="arguments as a JSON object, the other flags take precedence",
+    )
+    for name in ARGUMENT_NAMES:
+        if name in ("prompt", "options", "data_type") or name in OBJECT_ARGUMENTS:
+            continue
+        flag = "--" + name.replace("_", "-")
+        if name in FLAG_ARGUMENTS:
+            parser.add_argument(flag, action="store_const", const=True)
+        else:
+            parser.add_argument(flag, type=ARGUMENT_TYPES.get(name, str))
+    parser.add_argument(
+        "--json-output", action="store_true", help="print the answer as JSON"
+    )
+    parser.add_argument(
+        "--coprocess",
+        action="store_true",
+        help="read JSON requests line by line and write a JSON result for each",
+    )
+    parser.add_argument("--input-fd", type=int, default=0)
+    parser.add_argument("--output-fd", type=int, default=1)
+    parser.add_argument("--tty", default="/dev/tty", help="terminal for the human")
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.coprocess:
+        if args.prompt is not None or args.request is not None:
+            parser.error("--coprocess takes its prompts from --input-fd")
+        try:
+            terminal_fd = os.open(args.tty, os.O_RDWR)
+        except OSError as e:
+            parser.error(f"--tty: {e.strerror}")
+        # duplicated, as stdin and stdout may be lent to the terminal
+        reader = os.fdopen(os.dup(args.input_fd), "r")
+        writer = os.fdopen(os.dup(args.output_fd), "w")
+        try:
+            with reader, writer, terminal_prompt_io(terminal_fd) as prompt_io:
+                serve_requests(reader, writer, prompt_io)
+        except BrokenPipeError:
+            pass
+        finally:
+            os.close(terminal_fd)
+        return 0
+
+    request = dict()
+    if args.request is not None:
+        try:
+            request = json.loads(args.request)
+        except ValueError as e:
+            parser.error(f"--json: {e}")
+    for name in ARGUMENT_NAMES:
+        value = getattr(args, name, None)
+        if value is not None and name != "options":
+            request[name] = value
+    if args.options is not None:
+        options = split_escaped_comma_separated_string(args.options)
+        if options is None:
+            parser.error("--options: unbalanced quotes")
+        request["options"] = list(options)
+    if args.default is not None and request.get("allow_multiple") is True:
+        # multiple defaults are given as a list
+        default = split_escaped_comma_separated_string(args.default)
+        if default is None:
+            parser.error("--default: unbalanced quotes")
+        request["default"] = list(default)
+    try:
+        arguments = load_request(request)
+    except TypeError as e:
+        parser.error(str(e))
+    try:
+        terminal_fd = os.open(args.tty, os.O_RDWR)
+    except OSError:
+        # without a controlling terminal, e.g. answers piped in
+        terminal_fd = None
+        terminal = nullcontext(PromptIO(sys.stdin, sys.stderr))
+    else:
+        terminal = terminal_prompt_io(terminal_fd)
+    try:
+        with terminal as prompt_io:
+            try:
+                answer = ask(arguments, prompt_io)
+            except KeyboardInterrupt:
+                prompt_io.write_line()
+                prompt_io.flush()
+                return EXIT_INTERRUPTED
+    except TypeError as e:
+        parser.error(str(e))
+    except (ValueError, EOFError) as e:
+        print(f"{parser.prog}: {str(e) or 'end of input'}", file=sys.stderr)
+        return EXIT_ERROR
+    except TimeoutError:
+        return EXIT_TIMEOUT
+    finally:
+        if terminal_fd is not None:
+            os.close(terminal_fd)
+    if args.json_output:
+        sys.stdout.write(json.dumps(get_json_value(answer)) + "\n")
+    else:
+        sys.stdout.write(format_answer(answer))
+    return 0
@@ -1,6 +1,36 @@
+import io
+import csv
+import mmap
+import zlib
+import os
 import sys
-import shlex
-from collections.abc import Iterable
+import json
+import pickle
+import hashlib
+import time
+import threading
+import re
+import select
+import asyncio
+import weakref
+import contextvars
+import concurrent.futures
+import functools
+import itertools
+from array import array
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
+
+try:
+    import readline
+except ImportError:
+    readline = None
+
+try:
+    import termios
+except ImportError:
+    termios = None
 
 # TODO: add a field type that is free text but with options to make it more convenient
 
@@ -23,17 +53,50 @@ ARGUMENT_NAMES = (
     "options_number_color",
     "input_line_color",
     "confirm_line_color",
+    "page_size",
+    "allow_search",
+    "allow_completion",
+    "prompt_io",
+    "on_metrics",
+    "history",
+    "option_validation",
+    "return_converted",
+    "timeout",
+    "session_log",
 )
 
 DEFAULTS = dict()
 
+# option lists from this size on are stored in a CompactOptionSet
+COMPACT_OPTIONS_MIN_SIZE = 10000
+
+# "eager" checks every option against data_type up front, "threads" and
+# "processes" do it in chunks on a pool and "lazy" only checks the options
+# that are picked
+OPTION_VALIDATION_MODES = ("eager", "threads", "processes", "lazy")
+VALIDATION_CHUNK_SIZE = 2000
+VALIDATION_EXECUTORS = dict()
+
+# data_type results per option value, so repeated prompts skip the
+# conversion; data_type is expected to give the same result for the same
+# value, its entry goes with it
+CONVERTED_VALUES = weakref.WeakKeyDictionary()
+CONVERTED_VALUES_MAX_SIZE = 1000000
+
+# defaults set by prompt_defaults() take the place of DEFAULTS in the current
+# context and whatever is started from it (asyncio tasks copy the context)
+SCOPED_DEFAULTS = contextvars.ContextVar("promptwithoptions_defaults", default=None)
+
 
 def cformat(text, color=None):
     return text if color is None else f"{color}{text}\u001b[0m"
 
 
-def cprint(text, color=None):
-    print(cformat(text, color))
+def cprint(text, color=None, prompt_io=None):
+    if prompt_io is None:
+        print(cformat(text, color))
+    else:
+        prompt_io.write_line(cformat(text, color))
 
 
 def cinput(text, color=None):
@@ -44,7 +107,790 @@ def is_ref_in_option(option, ref):
     return str(ref) in tuple(str(o) for o in option)
 
 
+def ref_to_position(ref):
+    try:
+        return int(ref)
+    except (TypeError, ValueError):
+        return None
+
+
+class OptionSet(object):
+    def __init__(self, options):
+        self.options = list()
+        self.index = dict()
+        self.ambiguous_refs = set()
+        for option in options:
+            self.add_option(option)
+        for ref, option in self.index.items():
+            if ref[:1].isdigit() or ref[:1] in " +-":
+                position = self.get_position(ref)
+                if position is not None and self.options[position] != option:
+                    self.ambiguous_refs.add(ref)
+
+    def __len__(self):
+        return len(self.options)
+
+    def __iter__(self):
+        return iter(self.options)
+
+    def __getitem__(self, index):
+        return self.options[index]
+
+    def add_option(self, option):
+        self.options.append(option)
+        for ref in option:
+            indexed_option = self.index.setdefault(ref, option)
+            if indexed_option != option:
+                self.ambiguous_refs.add(ref)
+
+    def pull(self, count):
+        return count <= len(self.options)
+
+    def window(self, start, stop):
+        self.pull(stop)
+        return self.options[start:stop]
+
+    def get_position(self, ref):
+        ref_int = ref_to_position(ref)
+        if ref_int is not None and ref_int >= 1 and self.pull(ref_int):
+            return ref_int - 1
+
+    def get(self, ref):
+        position = self.get_position(ref)
+        if position is not None:
+            return self.options[position]
+        return self.index.get(str(ref))
+
+    def complete(self, prefix):
+        completion_trie = getattr(self, "completion_trie", None)
+        if completion_trie is None:
+            completion_trie = CompletionTrie(ref for o in self for ref in o)
+            self.completion_trie = completion_trie
+        return completion_trie.complete(prefix)
+
+    def search(self, query):
+        search_index = getattr(self, "search_index", None)
+        if search_index is None:
+            search_index = OptionSearchIndex(get_option_str(o) for o in self)
+            self.search_index = search_index
+        return search_index.search(query)
+
+    def keys(self):
+        return [option[0] for option in self]
+
+    def cache_key(self):
+        # equal option lists give equal keys, whichever OptionSet holds them;
+        # a digest, so that cached renders do not keep the options alive
+        return self.fingerprint()
+
+    def fingerprint(self):
+        # stable across runs, unlike hash()
+        fingerprint = getattr(self, "cached_fingerprint", None)
+        if fingerprint is None:
+            fingerprint = hashlib.blake2b(
+                repr(self.options).encode("utf-8", "backslashreplace"),
+                digest_size=16,
+            ).hexdigest()
+            self.cached_fingerprint = fingerprint
+        return fingerprint
+
+
+def index_ngrams(texts, size):
+    ngrams = dict()
+    for position, text in enumerate(texts):
+        for ngram in {text[i : i + size] for i in range(len(text) - size + 1)}:
+            positions = ngrams.get(ngram)
+            if positions is None:
+                ngrams[ngram] = [position]
+            else:
+                positions.append(position)
+    return ngrams
+
+
+class OptionSearchIndex(object):
+    def __init__(self, texts):
+        self.texts = [text.lower() for text in texts]
+        self.trigrams = index_ngrams(self.texts, 3)
+        # two-letter queries are rare enough to index them on first use
+        self.bigrams = None
+        self.last_search = (None, None)
+
+    def search(self, query):
+        query = query.lower()
+        if len(query) == 2:
+            if self.bigrams is None:
+                self.bigrams = index_ngrams(self.texts, 2)
+            return self.bigrams.get(query, [])
+        candidates = range(len(self.texts))
+        if len(query) >= 3:
+            candidates = min(
+                (
+                    self.trigrams.get(query[i : i + 3], ())
+                    for i in range(len(query) - 2)
+                ),
+                key=len,
+            )
+        # a longer query can only narrow down the previous matches
+        last_query, last_matches = self.last_search
+        if (
+            last_query is not None
+            and last_query in query
+            and len(last_matches) < len(candidates)
+        ):
+            candidates = last_matches
+        texts = self.texts
+        matches = [position for position in candidates if query in texts[position]]
+        self.last_search = (query, matches)
+        return matches
+
+
+class CompletionTrieNode(object):
+    __slots__ = ("children", "lo", "hi")
+
+    def __init__(self, lo, hi):
+        # children: first character -> (edge label, child node)
+        self.children = dict()
+        self.lo = lo
+        self.hi = hi
+
+
+class CompletionTrie(object):
+    # a radix trie over the sorted values where every node holds the range
+    # of values sharing its prefix, so a lookup costs the prefix length only
+    def __init__(self, values):
+        self.values = sorted(set(values))
+        self.root = CompletionTrieNode(0, len(self.values))
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            position = node.lo
+            while position < node.hi and len(self.values[position]) == depth:
+                position += 1
+            while position < node.hi:
+                first = self.values[position]
+                char = first[depth]
+                end = position + 1
+                while end < node.hi and self.values[end][depth] == char:
+                    end += 1
+                last = self.values[end - 1]
+                common = depth + 1
+                while (
+                    common < len(first)
+                    and common < len(last)
+                    and first[common] == last[common]
+                ):
+                    common += 1
+                child = CompletionTrieNode(position, end)
+                node.children[char] = (first[depth:common], child)
+                stack.append((child, common))
+                position = end
+
+    def complete(self, prefix):
+        node = self.root
+        depth = 0
+        while depth < len(prefix):
+            edge = node.children.get(prefix[depth])
+            if edge is None:
+                return []
+            label, node = edge
+            segment = prefix[depth : depth + len(label)]
+            if not label.startswith(segment):
+                return []
+            depth += len(label)
+        return self.values[node.lo : node.hi]
+
+
+class LazyOptionSet(OptionSet):
+    # options are pulled from the source only as far as a lookup or the
+    # display needs them; refs shadowed by position numbers are not flagged
+    def __init__(self, source, data_type=None):
+        super().__init__(())
+        self.source = source
+        self.data_type = data_type
+        self.iterator = None
+        self.exhausted = False
+
+    def __len__(self):
+        self.pull_all()
+        return len(self.options)
+
+    def __bool__(self):
+        return self.pull(1)
+
+    def __iter__(self):
+        position = 0
+        while self.pull(position + 1):
+            yield self.options[position]
+            position += 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.stop is None or index.stop < 0 or (index.start or 0) < 0:
+                self.pull_all()
+            else:
+                self.pull(index.stop)
+        elif index < 0:
+            self.pull_all()
+        else:
+            self.pull(index + 1)
+        return self.options[index]
+
+    def add_option(self, option):
+        if self.data_type is not None:
+            try:
+                self.data_type(option[0])
+            except Exception:
+                raise TypeError(
+                    f"options: data_type validation failed: {get_option_str(option)}"
+                )
+        super().add_option(option)
+
+    def pull(self, count):
+        if self.iterator is None:
+            source = self.source() if callable(self.source) else self.source
+            if isinstance(source, dict):
+                source = source.items()
+            self.iterator = iter(source)
+        while len(self.options) < count and not self.exhausted:
+            try:
+                option = next(self.iterator)
+            except StopIteration:
+                self.exhausted = True
+            else:
+                self.add_option(normalise_option(option))
+        return count <= len(self.options)
+
+    def pull_all(self):
+        while not self.exhausted:
+            self.pull(len(self.options) + 1)
+
+    def cache_key(self):
+        # the options seen so far can still grow, renders are not cached
+        return None
+
+    def fingerprint(self):
+        # taking the whole source into account would defeat the laziness
+        return None
+
+    def get(self, ref):
+        position = self.get_position(ref)
+        if position is not None:
+            return self.options[position]
+        ref = str(ref)
+        option = self.index.get(ref)
+        while option is None and self.pull(len(self.options) + 1):
+            option = self.index.get(ref)
+        return option
+
+
+def get_array_typecode(max_value):
+    return "I" if max_value < 1 << 32 else "Q"
+
+
+class CompactOptionSet(OptionSet):
+    # all values are stored in one string with an array of end offsets and
+    # only become tuples while they are handed out; refs are looked up in an
+    # open addressing table of option numbers placed by the hash of the ref
+    def __init__(self, options):
+        if isinstance(options, dict):
+            options = options.items()
+        values = list()
+        option_ends = list()
+        for option in options:
+            values.extend(normalise_option(option))
+            option_ends.append(len(values))
+        self.blob = "".join(values)
+        self.value_ends = array(
+            get_array_typecode(len(self.blob)), itertools.accumulate(map(len, values))
+        )
+        self.option_ends = array(get_array_typecode(len(values)), option_ends)
+        # at most half full, so a probe rarely passes more than a slot or two
+        table_size = 1 << max(3, (2 * len(values)).bit_length())
+        self.table = array(get_array_typecode(len(option_ends) + 1), [0]) * table_size
+        self.mask = table_size - 1
+        self.ambiguous_refs = set()
+        position_like_refs = list()
+        table = self.table
+        mask = self.mask
+        start = 0
+        for number, end in enumerate(option_ends, 1):
+            option_values = values[start:end]
+            for value in option_values:
+                slot = hash(value) & mask
+                # the first slot whose option holds the value decides, even
+                # if it was placed there for another value of that option
+                while True:
+                    existing = table[slot]
+                    if existing == 0:
+                        table[slot] = existing = number
+                        break
+                    existing_start = option_ends[existing - 2] if existing > 1 else 0
+                    existing_values = values[existing_start : option_ends[existing - 1]]
+                    if value in existing_values:
+                        break
+                    slot = (slot + 1) & mask
+                if existing != number:
+                    if existing_values != option_values:
+                        self.ambiguous_refs.add(value)
+                elif value[:1].isdigit() or value[:1] in " +-":
+                    position_like_refs.append((value, number - 1))
+            start = end
+        for ref, position in position_like_refs:
+            ref_position = self.get_position(ref)
+            if ref_position is not None and self[ref_position] != self[position]:
+                self.ambiguous_refs.add(ref)
+
+    def __len__(self):
+        return len(self.option_ends)
+
+    def __iter__(self):
+        return map(self.get_option_at, range(len(self.option_ends)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [
+                self.get_option_at(position)
+                for position in range(*index.indices(len(self.option_ends)))
+            ]
+        if index < 0:
+            index += len(self.option_ends)
+        if not 0 <= index < len(self.option_ends):
+            raise IndexError("option index out of range")
+        return self.get_option_at(index)
+
+    def get_option_at(self, position):
+        blob = self.blob
+        value_ends = self.value_ends
+        value_start = self.option_ends[position - 1] if position else 0
+        start = value_ends[value_start - 1] if value_start else 0
+        option = list()
+        for end in value_ends[value_start : self.option_ends[position]]:
+            option.append(blob[start:end])
+            start = end
+        return tuple(option)
+
+    def add_option(self, option):
+        raise TypeError("options: CompactOptionSet cannot be extended")
+
+    def keys(self):
+        blob = self.blob
+        value_ends = self.value_ends
+        value_starts = itertools.chain((0,), self.option_ends[:-1])
+        keys = list()
+        for value_start in value_starts:
+            start = value_ends[value_start - 1] if value_start else 0
+            keys.append(blob[start : value_ends[value_start]])
+        return keys
+
+    def pull(self, count):
+        return count <= len(self.option_ends)
+
+    def window(self, start, stop):
+        return self[start:stop]
+
+    def get(self, ref):
+        position = self.get_position(ref)
+        if position is not None:
+            return self.get_option_at(position)
+        ref = str(ref)
+        table = self.table
+        slot = hash(ref) & self.mask
+        while table[slot]:
+            option = self.get_option_at(table[slot] - 1)
+            if ref in option:
+                return option
+            slot = (slot + 1) & self.mask
+
+    def cache_key(self):
+        # hashed from the blob and offsets, much faster than fingerprint()
+        cached_key = getattr(self, "cached_key", None)
+        if cached_key is None:
+            digest = hashlib.blake2b(
+                self.blob.encode("utf-8", "surrogatepass"), digest_size=16
+            )
+            digest.update(self.value_ends)
+            digest.update(self.option_ends)
+            cached_key = ("compact", digest.hexdigest())
+            self.cached_key = cached_key
+        return cached_key
+
+    def fingerprint(self):
+        # the same as for an OptionSet with these options
+        fingerprint = getattr(self, "cached_fingerprint", None)
+        if fingerprint is None:
+            fingerprint = hashlib.blake2b(
+                repr(list(self)).encode("utf-8", "backslashreplace"),
+                digest_size=16,
+            ).hexdigest()
+            self.cached_fingerprint = fingerprint
+        return fingerprint
+
+
+def get_ref_crc32(ref):
+    # independent of the file encoding, which cannot encode every typed ref
+    return zlib.crc32(ref.encode("utf-8", "surrogatepass"))
+
+
+class FileOptionSet(OptionSet):
+    # options read on demand from a CSV, TSV or JSON lines file with one
+    # option per line; the file is memory mapped and only the line offsets
+    # and a table of line numbers placed by the crc32 of every ref are kept,
+    # both cached in a ".pwoidx" file next to it
+    FORMATS = ("csv", "tsv", "jsonl")
+    INDEX_VERSION = 2
+
+    def __init__(self, path, format=None, header=False, encoding="utf-8"):
+        if format is None:
+            extension = os.path.splitext(path)[1].lower().lstrip(".")
+            format = "jsonl" if extension in ("json", "ndjson") else extension
+        if format not in self.FORMATS:
+            raise TypeError(f"format: one of {', '.join(self.FORMATS)} expected")
+        self.path = path
+        self.format = format
+        self.header = header
+        self.encoding = encoding
+        with open(path, "rb") as data_file:
+            stat = os.fstat(data_file.fileno())
+            self.file_id = (stat.st_size, stat.st_mtime_ns)
+            if stat.st_size == 0:
+                self.data = b""
+            else:
+                self.data = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index_path = f"{path}.pwoidx"
+        if not self.load_index():
+            self.build_index()
+            self.save_index()
+
+    def __len__(self):
+        return len(self.line_starts)
+
+    def __iter__(self):
+        return map(self.get_option_at, range(len(self.line_starts)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [
+                self.get_option_at(position)
+                for position in range(*index.indices(len(self.line_starts)))
+            ]
+        if index < 0:
+            index += len(self.line_starts)
+        if not 0 <= index < len(self.line_starts):
+            raise IndexError("option index out of range")
+        return self.get_option_at(index)
+
+    def parse_line(self, line):
+        text = line.decode(self.encoding)
+        if self.format == "tsv":
+            return tuple(text.split("\t"))
+        if self.format == "csv":
+            return tuple(next(csv.reader((text,))))
+        row = json.loads(text)
+        if isinstance(row, dict):
+            row = tuple(row.values())
+        return normalise_option(row)
+
+    def get_option_at(self, position):
+        start = self.line_starts[position]
+        end = self.data.find(b"\n", start)
+        line = self.data[start : len(self.data) if end == -1 else end]
+        return self.parse_line(line.rstrip(b"\r"))
+
+    def add_option(self, option):
+        raise TypeError("options: FileOptionSet cannot be extended")
+
+    def pull(self, count):
+        return count <= len(self.line_starts)
+
+    def window(self, start, stop):
+        return self[start:stop]
+
+    def get(self, ref):
+        position = self.get_position(ref)
+        if position is not None:
+            return self.get_option_at(position)
+        ref = str(ref)
+        table = self.table
+        slot = get_ref_crc32(ref) & self.mask
+        while table[slot]:
+            option = self.get_option_at(table[slot] - 1)
+            if ref in option:
+                return option
+            slot = (slot + 1) & self.mask
+
+    def build_index(self):
+        data = self.data
+        line_starts = list()
+        position = 0
+        if self.header:
+            position = data.find(b"\n") + 1 or len(data)
+        while position < len(data):
+            end = data.find(b"\n", position)
+            if end == -1:
+                end = len(data)
+            if data[position:end].strip():
+                line_starts.append(position)
+            position = end + 1
+        self.line_starts = array(get_array_typecode(len(data)), line_starts)
+        value_count = sum(map(len, self))
+        table_size = 1 << max(3, (2 * value_count).bit_length())
+        self.table = array(get_array_typecode(len(line_starts) + 1), [0]) * table_size
+        self.mask = table_size - 1
+        self.ambiguous_refs = set()
+        # the same first-wins placement as in CompactOptionSet, with crc32 so
+        # that the table stays valid for the next process
+        table = self.table
+        mask = self.mask
+        position_like_refs = list()
+        for number, option in enumerate(self, 1):
+            for value in option:
+                slot = get_ref_crc32(value) & mask
+                while True:
+                    existing = table[slot]
+                    if existing == 0:
+                        table[slot] = existing = number
+                        break
+                    existing_option = self.get_option_at(existing - 1)
+                    if value in existing_option:
+                        break
+                    slot = (slot + 1) & mask
+                if existing != number:
+                    if existing_option != option:
+                        self.ambiguous_refs.add(value)
+                elif value[:1].isdigit() or value[:1] in " +-":
+                    position_like_refs.append((value, number - 1))
+        for ref, position in position_like_refs:
+            ref_position = self.get_position(ref)
+            if ref_position is not None and self[ref_position] != self[position]:
+                self.ambiguous_refs.add(ref)
+
+    def get_index_header(self):
+        return {
+            "version": self.INDEX_VERSION,
+            "file": list(self.file_id),
+            "format": self.format,
+            "header": self.header,
+            "encoding": self.encoding,
+            "byteorder": sys.byteorder,
+        }
+
+    def load_index(self):
+        try:
+            with open(self.index_path, "rb") as index_file:
+                header = json.loads(index_file.readline())
+                arrays = header.pop("arrays")
+                ambiguous_refs = header.pop("ambiguous_refs")
+                if header != self.get_index_header():
+                    return False
+                loaded_arrays = list()
+                for typecode, count in arrays:
+                    loaded_array = array(typecode)
+                    loaded_array.fromfile(index_file, count)
+                    loaded_arrays.append(loaded_array)
+        except (OSError, ValueError, KeyError, TypeError, EOFError):
+            # missing, stale or damaged: built again
+            return False
+        self.line_starts, self.table = loaded_arrays
+        self.mask = len(self.table) - 1
+        self.ambiguous_refs = set(ambiguous_refs)
+        return True
+
+    def save_index(self):
+        header = self.get_index_header()
+        header["arrays"] = [
+            (self.line_starts.typecode, len(self.line_starts)),
+            (self.table.typecode, len(self.table)),
+        ]
+        header["ambiguous_refs"] = sorted(self.ambiguous_refs)
+        temporary_path = f"{self.index_path}.tmp"
+        try:
+            with open(temporary_path, "wb") as index_file:
+                index_file.write(json.dumps(header).encode("utf-8") + b"\n")
+                self.line_starts.tofile(index_file)
+                self.table.tofile(index_file)
+            os.replace(temporary_path, self.index_path)
+        except OSError:
+            # e.g. a read-only directory, the index is then built every time
+            pass
+
+    def keys(self):
+        return [option[0] for option in self]
+
+    def cache_key(self):
+        return (self.path, self.file_id, self.format, self.header, self.encoding)
+
+    def fingerprint(self):
+        # by content, so a copy of the file gives the same fingerprint
+        fingerprint = getattr(self, "cached_fingerprint", None)
+        if fingerprint is None:
+            fingerprint = hashlib.blake2b(
+                repr(self.cache_key()[2:]).encode("utf-8"), digest_size=16
+            )
+            fingerprint.update(self.data)
+            fingerprint = fingerprint.hexdigest()
+            self.cached_fingerprint = fingerprint
+        return fingerprint
+
+
+def is_lazy_options(options):
+    return isinstance(options, Iterator) or (
+        callable(options) and not isinstance(options, Iterable)
+    )
+
+
+def compile_options(options, data_type=None):
+    if options is None or isinstance(options, OptionSet):
+        return options
+    if isinstance(options, OptionProvider):
+        return options()
+    if is_lazy_options(options):
+        return LazyOptionSet(options, data_type)
+    if len(options) >= COMPACT_OPTIONS_MIN_SIZE:
+        return CompactOptionSet(options)
+    return OptionSet(normalise_options(options))
+
+
+class OptionProvider(object):
+    # option sets built by source(*args, **kwargs) are shared by every prompt
+    # and thread asking with the same key until ttl seconds pass, and the
+    # least recently used are dropped beyond max_entries; concurrent misses
+    # for one key wait for a single build
+    def __init__(self, source, ttl=None, max_entries=128, key=None):
+        if not callable(source):
+            raise TypeError("source: callable expected")
+        if ttl is not None and (
+            not isinstance(ttl, (int, float)) or isinstance(ttl, bool) or ttl <= 0
+        ):
+            raise TypeError("ttl: positive number expected")
+        if (
+            not isinstance(max_entries, int)
+            or isinstance(max_entries, bool)
+            or max_entries < 1
+        ):
+            raise TypeError("max_entries: positive int expected")
+        if key is not None and not callable(key):
+            raise TypeError("key: callable expected")
+        functools.update_wrapper(self, source)
+        self.source = source
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.key = key
+        self.entries = OrderedDict()
+        self.builds = dict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.build_count = 0
+        self.build_time = 0.0
+        self.last_build_time = 0.0
+
+    def __call__(self, *args, **kwargs):
+        key = self.get_key(args, kwargs)
+        with self.lock:
+            option_set = self.lookup(key)
+            if option_set is not None:
+                return option_set
+            build_lock = self.builds.setdefault(key, threading.Lock())
+        with build_lock:
+            with self.lock:
+                # built while waiting for the lock
+                option_set = self.lookup(key, count_miss=True)
+                if option_set is not None:
+                    return option_set
+            started = time.perf_counter()
+            try:
+                option_set = self.build(args, kwargs)
+            except BaseException:
+                with self.lock:
+                    self.builds.pop(key, None)
+                raise
+            build_time = time.perf_counter() - started
+            with self.lock:
+                expires = None if self.ttl is None else time.monotonic() + self.ttl
+                self.entries[key] = (option_set, expires)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+                self.builds.pop(key, None)
+                self.build_count += 1
+                self.build_time += build_time
+                self.last_build_time = build_time
+        return option_set
+
+    def get_key(self, args, kwargs):
+        if self.key is not None:
+            return self.key(*args, **kwargs)
+        return (args, tuple(sorted(kwargs.items())))
+
+    def lookup(self, key, count_miss=False):
+        entry = self.entries.get(key)
+        if entry is not None:
+            option_set, expires = entry
+            if expires is None or time.monotonic() < expires:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return option_set
+            del self.entries[key]
+            self.expirations += 1
+        if count_miss:
+            self.misses += 1
+        return None
+
+    def build(self, args, kwargs):
+        options = self.source(*args, **kwargs)
+        if isinstance(options, OptionSet):
+            if isinstance(options, LazyOptionSet):
+                options.pull_all()
+            return options
+        if (
+            options is None
+            or isinstance(options, str)
+            or (not isinstance(options, Iterable))
+        ):
+            raise TypeError("options: iterable expected")
+        if isinstance(options, Iterator):
+            # a shared option set has to hold all options
+            options = list(options)
+        return compile_options(options)
+
+    def invalidate(self, *args, **kwargs):
+        # without arguments every cached option set is dropped
+        with self.lock:
+            if not args and not kwargs:
+                self.invalidations += len(self.entries)
+                self.entries.clear()
+            elif self.entries.pop(self.get_key(args, kwargs), None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "builds": self.build_count,
+                "build_time": self.build_time,
+                "last_build_time": self.last_build_time,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+def cached_options(ttl=None, max_entries=128, key=None):
+    def decorate(source):
+        return OptionProvider(source, ttl, max_entries, key)
+
+    return decorate
+
+
 def get_option(options, ref):
+    if isinstance(options, OptionSet):
+        return options.get(ref)
     try:
         ref_int = int(ref)
     except:
@@ -81,13 +927,13 @@ def get_formatted_prompt(
             normalised_bool_default = tuple(map(normalise_value_to_YN, default))
         else:
             normalised_bool_default = (str(default),)
-        new_normalised_bool_default = tuple()
+        new_normalised_bool_default = list()
         for response_item in normalised_bool_default:
-            new_normalised_bool_default += tuple(
+            new_normalised_bool_default.extend(
                 normalise_value_to_YN(x)
                 for x in split_escaped_comma_separated_string(response_item)
             )
-        normalised_bool_default = new_normalised_bool_default
+        normalised_bool_default = tuple(new_normalised_bool_default)
         if len(normalised_bool_default) == 1:
             if normalised_bool_default[0] == "Y":
                 bool_choice = "Y/n"
@@ -137,45 +983,151 @@ def get_option_str(option, hide_key=None):
         return " - ".join(str(o) if o != "" else "''" for o in option)
 
 
+class RenderCache(object):
+    # rendered prompt lines and option lists, least recently used entries
+    # are dropped beyond max_entries or max_chars of rendered text
+    def __init__(self, max_entries=256, max_chars=1 << 24):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.entries = OrderedDict()
+        self.chars = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, render):
+        if key is None:
+            return render()
+        try:
+            with self.lock:
+                rendered = self.entries.get(key)
+                if rendered is not None:
+                    self.entries.move_to_end(key)
+                    return rendered
+        except TypeError:
+            # unhashable settings, e.g. a default in a set
+            return render()
+        rendered = render()
+        if rendered is None or len(rendered) > self.max_chars:
+            return rendered
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = rendered
+                self.chars += len(rendered)
+                while (
+                    len(self.entries) > self.max_entries or self.chars > self.max_chars
+                ):
+                    self.chars -= len(self.entries.popitem(last=False)[1])
+        return rendered
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.chars = 0
+
+
+RENDER_CACHE = RenderCache()
+
+
 def get_formatted_option(
     option, hide_key=None, options_line_color=None, options_number_color=None
 ):
     return cformat(get_option_str(option, hide_key=hide_key), options_line_color)
 
 
-def print_formatted_options(
+def iter_formatted_options(
+    options,
+    hide_key=None,
+    options_line_color=None,
+    options_number_color=None,
+    start=0,
+):
+    for index, option in enumerate(options, start):
+        yield format_numbered_option(
+            index + 1, option, hide_key, options_line_color, options_number_color
+        )
+
+
+def format_numbered_option(
+    number, option, hide_key=None, options_line_color=None, options_number_color=None
+):
+    return (
+        cformat(str(number), options_number_color)
+        + " > "
+        + get_formatted_option(
+            option,
+            hide_key=hide_key,
+            options_line_color=options_line_color,
+            options_number_color=options_line_color,
+        )
+    )
+
+
+def format_options(
     options, hide_key=None, options_line_color=None, options_number_color=None
 ):
     if options is None:
         return
-    formatted_options = list()
-    for index, option in enumerate(options):
-        formatted_option = (
-            cformat(str(index + 1), options_number_color)
-            + " > "
-            + get_formatted_option(
-                option,
-                hide_key=hide_key,
-                options_line_color=options_line_color,
-                options_number_color=options_line_color,
-            )
+    return "\n".join(
+        iter_formatted_options(
+            options, hide_key, options_line_color, options_number_color
         )
-        formatted_options.append(formatted_option)
-    print("\n".join(formatted_options))
+    )
+
+
+def print_formatted_options(
+    options,
+    hide_key=None,
+    options_line_color=None,
+    options_number_color=None,
+    prompt_io=None,
+):
+    if options is None:
+        return
+    if isinstance(options, LazyOptionSet):
+        # print as the options arrive instead of realising the source first
+        empty = True
+        for formatted_option in iter_formatted_options(
+            options, hide_key, options_line_color, options_number_color
+        ):
+            cprint(formatted_option, prompt_io=prompt_io)
+            empty = False
+        if empty:
+            cprint("", prompt_io=prompt_io)
+        return
+    cprint(
+        format_options(options, hide_key, options_line_color, options_number_color),
+        prompt_io=prompt_io,
+    )
+
+
+def parse_page_command(response, page):
+    if response == ">":
+        return page + 1
+    if response == "<":
+        return page - 1
+    if response.startswith(">"):
+        page_number = ref_to_position(response[1:])
+        if page_number is not None:
+            return page_number - 1
 
 
 def print_formatted_confirmation(
-    prompt, response, hide_questionmark, confirm_line_color
+    prompt, response, hide_questionmark, confirm_line_color, prompt_io=None
 ):
     if hide_questionmark is True:
         # we suppose the user provides it so we're not adding ':'
         cprint(
-            f"{prompt} %s" % (response if response != "" else "''",), confirm_line_color
+            f"{prompt} %s" % (response if response != "" else "''",),
+            confirm_line_color,
+            prompt_io,
         )
     else:
         cprint(
             f"{prompt}: %s" % (response if response != "" else "''",),
             confirm_line_color,
+            prompt_io,
         )
 
 
@@ -191,43 +1143,287 @@ def normalise_options(options):
         return
     if isinstance(options, dict):
         options = tuple(options.items())
-    _options = list()
-    for option in options:
-        if isinstance(option, Iterable) and not isinstance(option, str):
-            _options.append(tuple(str(i) for i in option))
-        else:
-            _options.append((str(option),))
-    return _options
+    return [normalise_option(option) for option in options]
+
+
+def normalise_option(option):
+    if isinstance(option, Iterable) and not isinstance(option, str):
+        return tuple(str(i) for i in option)
+    else:
+        return (str(option),)
+
+
+def quote_value(value):
+    if any(char in value for char in ",\"'\\#"):
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return value
 
 
-def clear_back_last_input():
-    sys.stdout.write("\033[F\033[K")
+def clear_back_last_input(prompt_io=None):
+    if prompt_io is None:
+        sys.stdout.write("\033[F\033[K")
+    else:
+        prompt_io.write("\033[F\033[K")
+
+
+# characters with a meaning to the tokenizer besides the comma
+SPLIT_SPECIAL_CHARACTERS = re.compile(r"[\"'\\#]")
+SPLIT_PLAIN_RUN = re.compile(r"[^,\"'\\#]+")
+SPLIT_DOUBLE_QUOTED_RUN = re.compile(r'[^"\\]+')
 
 
 def split_escaped_comma_separated_string(the_string):
-    try:
-        splitter = shlex.shlex(the_string, posix=True)
-        splitter.whitespace = ","
-        splitter.whitespace_split = True
-        return tuple(s.strip() for s in splitter)
-    except ValueError:
-        return None
+    # a single pass over the string with the rules of a posix shlex splitting
+    # on commas: quotes, backslash escapes (also inside double quotes) and #
+    # comments up to the end of the line, empty unquoted items are skipped
+    if SPLIT_SPECIAL_CHARACTERS.search(the_string) is None:
+        return tuple(part.strip() for part in the_string.split(",") if part)
+    parts = list()
+    token = list()
+    in_token = False
+    position = 0
+    length = len(the_string)
+    while position < length:
+        character = the_string[position]
+        if character == ",":
+            if in_token:
+                parts.append("".join(token).strip())
+                token.clear()
+                in_token = False
+            position += 1
+        elif character == "#":
+            if in_token:
+                parts.append("".join(token).strip())
+                token.clear()
+                in_token = False
+            line_end = the_string.find("\n", position)
+            position = length if line_end == -1 else line_end + 1
+        elif character == "\\":
+            if position + 1 == length:
+                return None
+            token.append(the_string[position + 1])
+            in_token = True
+            position += 2
+        elif character == "'":
+            quote_end = the_string.find("'", position + 1)
+            if quote_end == -1:
+                return None
+            token.append(the_string[position + 1 : quote_end])
+            in_token = True
+            position = quote_end + 1
+        elif character == '"':
+            position += 1
+            while True:
+                if position == length:
+                    return None
+                character = the_string[position]
+                if character == '"':
+                    break
+                if character == "\\":
+                    if position + 1 == length:
+                        return None
+                    escaped = the_string[position + 1]
+                    if escaped not in '\\"':
+                        token.append(character)
+                    token.append(escaped)
+                    position += 2
+                else:
+                    run = SPLIT_DOUBLE_QUOTED_RUN.match(the_string, position)
+                    token.append(run.group())
+                    position = run.end()
+            in_token = True
+            position += 1
+        else:
+            run = SPLIT_PLAIN_RUN.match(the_string, position)
+            token.append(run.group())
+            in_token = True
+            position = run.end()
+    if in_token:
+        parts.append("".join(token).strip())
+    return tuple(parts)
+
+
+def get_prompt_defaults():
+    scoped_defaults = SCOPED_DEFAULTS.get()
+    return DEFAULTS if scoped_defaults is None else scoped_defaults
 
 
 def resolve_defaults(locals, variable_names):
+    current_defaults = get_prompt_defaults()
     defaults = dict()
     for variable_name in variable_names:
         variable = locals[variable_name]
         defaults[variable_name] = (
             None
             if variable == "_None_"
-            else DEFAULTS.get(variable_name)
+            else current_defaults.get(variable_name)
             if variable is None
             else variable
         )
     return defaults
 
 
+def get_converted_values(data_type):
+    try:
+        converted_values = CONVERTED_VALUES.get(data_type)
+    except TypeError:
+        # an unhashable data_type or one without weak references is not
+        # memoised
+        return dict()
+    if converted_values is None or len(converted_values) >= CONVERTED_VALUES_MAX_SIZE:
+        converted_values = CONVERTED_VALUES[data_type] = dict()
+    return converted_values
+
+
+def convert_value(data_type, value):
+    # raises what data_type raises for an invalid value
+    converted_values = get_converted_values(data_type)
+    try:
+        return converted_values[value]
+    except KeyError:
+        converted_value = converted_values[value] = data_type(value)
+        return converted_value
+
+
+def convert_values(data_type, values):
+    # runs in the pool workers, failed conversions are marked by position as
+    # the exceptions may not survive pickling
+    converted_values = list()
+    failed_positions = list()
+    for position, value in enumerate(values):
+        try:
+            converted_values.append(data_type(value))
+        except Exception:
+            converted_values.append(None)
+            failed_positions.append(position)
+    return converted_values, failed_positions
+
+
+def get_validation_executor(option_validation):
+    executor = VALIDATION_EXECUTORS.get(option_validation)
+    if executor is None:
+        if option_validation == "threads":
+            executor = concurrent.futures.ThreadPoolExecutor()
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor()
+        VALIDATION_EXECUTORS[option_validation] = executor
+    return executor
+
+
+def find_invalid_options(option_set, data_type, option_validation=None):
+    converted_values = get_converted_values(data_type)
+    keys = option_set.keys()
+    pending_keys = [key for key in keys if key not in converted_values]
+    if not pending_keys:
+        return list()
+    if option_validation in (None, "eager") or (
+        len(pending_keys) < VALIDATION_CHUNK_SIZE
+    ):
+        invalid_keys = set()
+        for key in pending_keys:
+            try:
+                converted_values[key] = data_type(key)
+            except:
+                invalid_keys.add(key)
+    else:
+        executor = get_validation_executor(option_validation)
+        chunks = [
+            pending_keys[start : start + VALIDATION_CHUNK_SIZE]
+            for start in range(0, len(pending_keys), VALIDATION_CHUNK_SIZE)
+        ]
+        futures = [executor.submit(convert_values, data_type, c) for c in chunks]
+        invalid_keys = set()
+        for chunk, future in zip(chunks, futures):
+            chunk_values, failed_positions = future.result()
+            failed_positions = set(failed_positions)
+            for position, key in enumerate(chunk):
+                if position in failed_positions:
+                    invalid_keys.add(key)
+                else:
+                    converted_values[key] = chunk_values[position]
+    if not invalid_keys:
+        return list()
+    return [
+        option_set[position] for position, key in enumerate(keys) if key in invalid_keys
+    ]
+
+
+def validate_default(
+    default, option_set, data_type, allow_empty, allow_multiple, allow_repetitive
+):
+    if isinstance(default, str):
+        if allow_multiple is True:
+            default_parts = split_escaped_comma_separated_string(default)
+        else:
+            default_parts = (default,)
+    elif isinstance(default, Iterable):
+        default_parts = tuple(
+            "Y" if part is True else "N" if part is False else str(part)
+            for part in default
+        )
+    elif isinstance(default, bool):
+        default_parts = (normalise_value_to_YN(default),)
+    else:
+        default_parts = (
+            "Y" if default is True else "N" if default is False else str(default),
+        )
+    if allow_empty is not True and len(default_parts) == 0:
+        raise TypeError(f"default: empty value is invalid when allow_empty is not True")
+    if allow_multiple is not True and len(default_parts) > 1:
+        raise TypeError(
+            f"default: multiple values found when allow_multiple is not True"
+        )
+    if option_set is not None:
+        default_options = tuple(option_set.get(part) for part in default_parts)
+    if allow_repetitive is not True:
+        if option_set is not None:
+            if len(default_options) != len(set(default_options)):
+                raise TypeError(
+                    f"default: repetitive elements found when allow_repetitive is not True"
+                )
+        else:
+            if len(default_parts) != len(set(default_parts)):
+                raise TypeError(
+                    f"default: repetitive elements found when allow_repetitive is not True"
+                )
+    invalid_parts = list()
+    if option_set is None:
+        if data_type is not None:
+            if data_type is bool:
+                for default_part in default_parts:
+                    if normalise_value_to_YN(default_part) is None:
+                        invalid_parts.append(default_part)
+            else:
+                for default_part in default_parts:
+                    try:
+                        data_type(default_part)
+                    except:
+                        invalid_parts.append(default_part)
+            if invalid_parts:
+                raise TypeError(
+                    f"default: type of data_type expected, got {', '.join(invalid_parts)}"
+                )
+    else:
+        for default_part, default_option in zip(default_parts, default_options):
+            if default_option is None:
+                invalid_parts.append(default_part)
+        if invalid_parts:
+            raise TypeError(
+                f"default: must be in options, got {', '.join(invalid_parts)}"
+            )
+        if data_type is not None:
+            # already converted unless the options are validated lazily
+            for default_part, default_option in zip(default_parts, default_options):
+                try:
+                    convert_value(data_type, default_option[0])
+                except Exception:
+                    invalid_parts.append(default_part)
+            if invalid_parts:
+                raise TypeError(
+                    f"default: type of data_type expected, got {', '.join(invalid_parts)}"
+                )
+
+
 def validate_arguments(
     *,
     prompt=None,
@@ -247,15 +1443,28 @@ def validate_arguments(
     options_number_color=None,
     input_line_color=None,
     confirm_line_color=None,
+    page_size=None,
+    allow_search=None,
+    allow_completion=None,
+    prompt_io=None,
+    on_metrics=None,
+    history=None,
+    option_validation=None,
+    return_converted=None,
+    timeout=None,
+    session_log=None,
 ):
     if prompt is not None:
         if not isinstance(prompt, str):
             raise TypeError("prompt: string expected")
 
-    if options is not None:
+    if options is not None and not is_lazy_options(options):
         if not isinstance(options, Iterable) or isinstance(options, str):
             raise TypeError("options: iterable expected")
-        if len(options) != len(set(options)):
+        # compiled option sets are indexed already, duplicates included
+        if not isinstance(options, (dict, OptionSet)) and len(options) != len(
+            set(options)
+        ):
             raise TypeError("options: unique items expected")
 
     if data_type is not None:
@@ -264,83 +1473,50 @@ def validate_arguments(
         if data_type is bool and options is not None:
             raise TypeError("options: only None is accepted when data_type is bool")
 
-    if data_type is not None and options is not None:
-        invalid_options = list()
-        for option in normalise_options(options):
-            try:
-                data_type(option[0])
-            except:
-                invalid_options.append(option)
+    if (
+        option_validation is not None
+        and option_validation not in OPTION_VALIDATION_MODES
+    ):
+        raise TypeError(
+            "option_validation: one of "
+            + ", ".join(OPTION_VALIDATION_MODES)
+            + " expected"
+        )
+
+    if option_validation == "processes" and data_type is not None:
+        # worker processes get data_type by reference, lambdas and local
+        # functions cannot be sent
+        try:
+            pickle.dumps(data_type)
+        except Exception:
+            raise TypeError(
+                "data_type: picklable callable expected when option_validation"
+                " is processes"
+            )
+
+    option_set = compile_options(options, data_type)
+
+    if (
+        data_type is not None
+        and options is not None
+        and not isinstance(option_set, LazyOptionSet)
+        and option_validation != "lazy"
+    ):
+        invalid_options = find_invalid_options(option_set, data_type, option_validation)
         if invalid_options:
             raise TypeError(
                 f"options: data_type validation failed: {', '.join(get_option_str(o) for o in invalid_options)}"
             )
 
     if default is not None:
-        if isinstance(default, str):
-            if allow_multiple is True:
-                default_parts = split_escaped_comma_separated_string(default)
-            else:
-                default_parts = (default,)
-        elif isinstance(default, Iterable):
-            default_parts = tuple(
-                "Y" if part is True else "N" if part is False else str(part)
-                for part in default
-            )
-        elif isinstance(default, bool):
-            default_parts = (normalise_value_to_YN(default),)
-        else:
-            default_parts = (
-                "Y" if default is True else "N" if default is False else str(default),
-            )
-        if allow_empty is not True and len(default_parts) == 0:
-            raise TypeError(
-                f"default: empty value is invalid when allow_empty is not True"
-            )
-        if allow_multiple is not True and len(default_parts) > 1:
-            raise TypeError(
-                f"default: multiple values found when allow_multiple is not True"
-            )
-        if allow_repetitive is not True:
-            if options is not None:
-                normalised_default_parts = tuple(
-                    get_option(normalise_options(options), part)
-                    for part in default_parts
-                )
-                if len(normalised_default_parts) != len(set(normalised_default_parts)):
-                    raise TypeError(
-                        f"default: repetitive elements found when allow_repetitive is not True"
-                    )
-            else:
-                if len(default_parts) != len(set(default_parts)):
-                    raise TypeError(
-                        f"default: repetitive elements found when allow_repetitive is not True"
-                    )
-        invalid_parts = list()
-        if options is None:
-            if data_type is not None:
-                if data_type is bool:
-                    for default_part in default_parts:
-                        if normalise_value_to_YN(default_part) is None:
-                            invalid_parts.append(default_part)
-                else:
-                    for default_part in default_parts:
-                        try:
-                            data_type(default_part)
-                        except:
-                            invalid_parts.append(default_part)
-                if invalid_parts:
-                    raise TypeError(
-                        f"default: type of data_type expected, got {', '.join(invalid_parts)}"
-                    )
-        else:
-            for default_part in default_parts:
-                if get_option(normalise_options(options), default_part) is None:
-                    invalid_parts.append(default_part)
-            if invalid_parts:
-                raise TypeError(
-                    f"default: must be in options, got {', '.join(invalid_parts)}"
-                )
+        validate_default(
+            default,
+            option_set,
+            data_type,
+            allow_empty,
+            allow_multiple,
+            allow_repetitive,
+        )
 
     if allow_empty is not None and not isinstance(allow_empty, bool):
         raise TypeError("allow_empty: bool expected")
@@ -383,6 +1559,43 @@ def validate_arguments(
     if confirm_line_color is not None and not isinstance(confirm_line_color, str):
         raise TypeError("confirm_line_color: str expected")
 
+    if page_size is not None and (
+        not isinstance(page_size, int) or isinstance(page_size, bool) or page_size < 1
+    ):
+        raise TypeError("page_size: positive int expected")
+
+    if allow_search is not None and not isinstance(allow_search, bool):
+        raise TypeError("allow_search: bool expected")
+
+    if allow_completion is not None and not isinstance(allow_completion, bool):
+        raise TypeError("allow_completion: bool expected")
+
+    if prompt_io is not None and not isinstance(prompt_io, PromptIO):
+        raise TypeError("prompt_io: PromptIO expected")
+
+    if on_metrics is not None and not callable(on_metrics):
+        raise TypeError("on_metrics: callable expected")
+
+    if history is not None and not isinstance(history, AnswerHistory):
+        raise TypeError("history: AnswerHistory expected")
+
+    if return_converted is not None and not isinstance(return_converted, bool):
+        raise TypeError("return_converted: bool expected")
+
+    if timeout is not None and (
+        not isinstance(timeout, (int, float))
+        or isinstance(timeout, bool)
+        or timeout <= 0
+    ):
+        raise TypeError("timeout: positive number expected")
+
+    if session_log is not None and not isinstance(
+        session_log, (SessionRecorder, SessionReplayer)
+    ):
+        raise TypeError("session_log: SessionRecorder or SessionReplayer expected")
+
+    return option_set
+
 
 def set_prompt_defaults(
     prompt=None,
@@ -402,17 +1615,36 @@ def set_prompt_defaults(
     options_number_color=None,
     input_line_color=None,
     confirm_line_color=None,
+    page_size=None,
+    allow_search=None,
+    allow_completion=None,
+    prompt_io=None,
+    on_metrics=None,
+    history=None,
+    option_validation=None,
+    return_converted=None,
+    timeout=None,
+    session_log=None,
 ):
     _DEFAULTS = resolve_defaults(locals(), ARGUMENT_NAMES)
     validate_arguments(**_DEFAULTS)
-    DEFAULTS.update(_DEFAULTS)
+    scoped_defaults = SCOPED_DEFAULTS.get()
+    if scoped_defaults is None:
+        DEFAULTS.update(_DEFAULTS)
+    else:
+        # never mutate a scope in place, other contexts may share it
+        SCOPED_DEFAULTS.set({**scoped_defaults, **_DEFAULTS})
 
 
 def reset_prompt_defaults():
-    DEFAULTS.clear()
+    if SCOPED_DEFAULTS.get() is None:
+        DEFAULTS.clear()
+    else:
+        SCOPED_DEFAULTS.set(dict())
 
 
-def promptwithoptions(
+@contextmanager
+def prompt_defaults(
     prompt=None,
     options=None,
     data_type=None,
@@ -430,192 +1662,1242 @@ def promptwithoptions(
     options_number_color=None,
     input_line_color=None,
     confirm_line_color=None,
+    page_size=None,
+    allow_search=None,
+    allow_completion=None,
+    prompt_io=None,
+    on_metrics=None,
+    history=None,
+    option_validation=None,
+    return_converted=None,
+    timeout=None,
+    session_log=None,
 ):
-    arguments = resolve_defaults(locals(), ARGUMENT_NAMES)
-    validate_arguments(**arguments)
-    prompt = arguments["prompt"]
-    options = arguments["options"]
-    data_type = arguments["data_type"]
-    default = arguments["default"]
-    allow_empty = arguments["allow_empty"]
-    allow_multiple = arguments["allow_multiple"]
-    allow_repetitive = arguments["allow_repetitive"]
-    show_confirmation = arguments["show_confirmation"]
-    hide_key = arguments["hide_key"]
-    hide_questionmark = arguments["hide_questionmark"]
-    hide_mandatory_sign = arguments["hide_mandatory_sign"]
-    hide_multiple_choice_sign = arguments["hide_multiple_choice_sign"]
-    no_interaction = arguments["no_interaction"]
-    options_line_color = arguments["options_line_color"]
-    options_number_color = arguments["options_number_color"]
-    input_line_color = arguments["input_line_color"]
-    confirm_line_color = arguments["confirm_line_color"]
-
-    options = normalise_options(options)
-    print_formatted_options(options, hide_key, options_line_color, options_number_color)
-    response = None
-    while response is None:
-        if no_interaction is True and default is not None:
-            print(
-                get_formatted_prompt(
-                    prompt,
-                    options,
-                    data_type,
-                    default,
-                    allow_empty,
-                    allow_multiple,
-                    hide_key,
-                    hide_questionmark,
-                    hide_mandatory_sign,
-                    hide_multiple_choice_sign,
-                    input_line_color,
-                )
-                + (str(default) if default != "" else "''")
-            )
-            response = ""
+    scoped_defaults = resolve_defaults(locals(), ARGUMENT_NAMES)
+    validate_arguments(**scoped_defaults)
+    token = SCOPED_DEFAULTS.set(scoped_defaults)
+    try:
+        yield
+    finally:
+        SCOPED_DEFAULTS.reset(token)
+
+
+class PromptSpec(object):
+    def __init__(self, arguments):
+        self.prompt = arguments["prompt"]
+        self.options = compile_options(arguments["options"])
+        self.data_type = arguments["data_type"]
+        self.default = arguments["default"]
+        self.allow_empty = arguments["allow_empty"]
+        self.allow_multiple = arguments["allow_multiple"]
+        self.allow_repetitive = arguments["allow_repetitive"]
+        self.show_confirmation = arguments["show_confirmation"]
+        self.hide_key = arguments["hide_key"]
+        self.hide_questionmark = arguments["hide_questionmark"]
+        self.hide_mandatory_sign = arguments["hide_mandatory_sign"]
+        self.hide_multiple_choice_sign = arguments["hide_multiple_choice_sign"]
+        self.no_interaction = arguments["no_interaction"]
+        self.options_line_color = arguments["options_line_color"]
+        self.options_number_color = arguments["options_number_color"]
+        self.input_line_color = arguments["input_line_color"]
+        self.confirm_line_color = arguments["confirm_line_color"]
+        self.page_size = arguments["page_size"]
+        self.allow_search = arguments["allow_search"]
+        self.allow_completion = arguments["allow_completion"]
+        self.prompt_io = arguments["prompt_io"] or DEFAULT_PROMPT_IO
+        self.on_metrics = arguments["on_metrics"]
+        self.history = arguments["history"]
+        self.option_validation = arguments["option_validation"]
+        self.return_converted = arguments["return_converted"]
+        self.timeout = arguments["timeout"]
+        self.session_log = arguments["session_log"]
+        self.compile_times = (0.0, 0.0, 0.0)
+        self.parsed_default = None
+
+        if isinstance(self.default, (list, tuple)):
+            # typed, so that True and 1 do not share an entry
+            default_key = tuple((type(part), part) for part in self.default)
+        elif self.default is not None:
+            default_key = (type(self.default), self.default)
         else:
-            response = input(
-                get_formatted_prompt(
-                    prompt,
-                    options,
-                    data_type,
-                    default,
-                    allow_empty,
-                    allow_multiple,
-                    hide_key,
-                    hide_questionmark,
-                    hide_mandatory_sign,
-                    hide_multiple_choice_sign,
-                    input_line_color,
-                )
+            default_key = None
+        # the options only show in the prompt through the default
+        uses_options = default_key is not None and self.options is not None
+        options_key = self.options.cache_key() if uses_options else None
+        if uses_options and options_key is None:
+            # lazy options have no cache key, such prompts are not cached
+            prompt_key = None
+        else:
+            prompt_key = (
+                "prompt",
+                self.prompt,
+                options_key,
+                self.data_type,
+                default_key,
+                self.allow_empty,
+                self.allow_multiple,
+                self.hide_key,
+                self.hide_questionmark,
+                self.hide_mandatory_sign,
+                self.hide_multiple_choice_sign,
+                self.input_line_color,
             )
-        if response == "" and default is not None:
-            if isinstance(default, Iterable) and not isinstance(default, str):
-                default_response = tuple(default)
+        self.formatted_prompt = RENDER_CACHE.get(
+            prompt_key,
+            lambda: get_formatted_prompt(
+                self.prompt,
+                self.options,
+                self.data_type,
+                self.default,
+                self.allow_empty,
+                self.allow_multiple,
+                self.hide_key,
+                self.hide_questionmark,
+                self.hide_mandatory_sign,
+                self.hide_multiple_choice_sign,
+                self.input_line_color,
+            ),
+        )
+        # the whole option list is rendered on the first print only, quiet
+        # answers and replays never need it
+        self.formatted_options = None
+        # pages of a fully known option list, rendered at most once per spec
+        self.formatted_pages = dict()
+        if self.default is not None:
+            self.formatted_default = str(self.default) if self.default != "" else "''"
+
+    def format_page(self, page, matches=None):
+        if matches is None and not isinstance(self.options, LazyOptionSet):
+            formatted_page = self.formatted_pages.get(page)
+            if formatted_page is None:
+                formatted_page = self.render_page(page)
+                self.formatted_pages[page] = formatted_page
+            return formatted_page
+        return self.render_page(page, matches)
+
+    def render_page(self, page, matches=None):
+        page_size = self.page_size
+        if matches is None:
+            start = page * page_size
+            # one extra option tells whether there is a next page
+            options = self.options.window(start, start + page_size + 1)
+            numbered_options = list(enumerate(options, start + 1))
+            if isinstance(self.options, LazyOptionSet) and not self.options.exhausted:
+                option_count = None
             else:
-                default_response = (str(default),)
-            new_default_response = tuple()
-            if data_type is bool:
-                new_default_response = tuple(
-                    normalise_value_to_YN(x) for x in default_response
-                )
+                option_count = len(self.options)
+        else:
+            if page_size is None:
+                page_size = max(len(matches), 1)
+            start = page * page_size
+            numbered_options = [
+                (position + 1, self.options[position])
+                for position in matches[start : start + page_size + 1]
+            ]
+            option_count = len(matches)
+        if page > 0 and len(numbered_options) == 0:
+            return
+        formatted_options = [
+            format_numbered_option(
+                number,
+                option,
+                self.hide_key,
+                self.options_line_color,
+                self.options_number_color,
+            )
+            for number, option in numbered_options[:page_size]
+        ]
+        footer = list()
+        if matches is not None:
+            footer.append(f"{len(matches)} found, '/' shows all")
+        if page > 0 or len(numbered_options) > page_size:
+            page_info = f"page {page + 1}"
+            if option_count is not None:
+                page_info += f" of {(option_count - 1) // page_size + 1}"
+            footer.append(f"{page_info} - '<' previous, '>' next, '>N' page N")
+        if footer:
+            formatted_options.append(
+                cformat("; ".join(footer), self.options_line_color)
+            )
+        return "\n".join(formatted_options)
+
+    def get_formatted_options(self):
+        if self.formatted_options is None:
+            self.formatted_options = RENDER_CACHE.get(
+                (
+                    "options",
+                    self.options.cache_key(),
+                    self.hide_key,
+                    self.options_line_color,
+                    self.options_number_color,
+                ),
+                lambda: format_options(
+                    self.options,
+                    self.hide_key,
+                    self.options_line_color,
+                    self.options_number_color,
+                ),
+            )
+        return self.formatted_options
+
+    def print_options(self):
+        if self.options is None:
+            return
+        if self.page_size is not None:
+            self.prompt_io.write_line(self.format_page(0))
+        elif not isinstance(self.options, LazyOptionSet):
+            self.prompt_io.write_line(self.get_formatted_options())
+        else:
+            print_formatted_options(
+                self.options,
+                self.hide_key,
+                self.options_line_color,
+                self.options_number_color,
+                self.prompt_io,
+            )
+
+    def parse_default_response(self):
+        # the default is split once per spec, not on every empty answer
+        if self.parsed_default is None:
+            self.parsed_default = self.split_default()
+        return self.parsed_default
+
+    def split_default(self):
+        default = self.default
+        if isinstance(default, Iterable) and not isinstance(default, str):
+            default_response = tuple(default)
+        else:
+            default_response = (str(default),)
+        new_default_response = tuple()
+        if self.data_type is bool:
+            new_default_response = tuple(
+                normalise_value_to_YN(x) for x in default_response
+            )
+        else:
+            if self.allow_multiple is True:
+                new_default_response = list()
+                for response_item in default_response:
+                    new_default_response.extend(
+                        split_escaped_comma_separated_string(str(response_item))
+                    )
+                new_default_response = tuple(new_default_response)
             else:
-                if allow_multiple is True:
-                    for response_item in default_response:
-                        new_default_response += split_escaped_comma_separated_string(
-                            str(response_item)
-                        )
-                else:
-                    new_default_response = default_response
-            default_response = new_default_response
-            if allow_multiple is not True and len(default_response) > 1:
-                response = None
-                clear_back_last_input()
-                continue
-            response = default_response or ""
-            break
+                new_default_response = default_response
+        default_response = new_default_response
+        if self.allow_multiple is not True and len(default_response) > 1:
+            return None
+        return default_response or ""
+
+    def parse_response(self, response):
+        if response == "" and self.default is not None:
+            return self.parse_default_response()
         if response in ("", "-"):
-            response = ""
-            if allow_empty is True:
-                break
-        if response == "":
-            response = None
-            clear_back_last_input()
-            continue
-        if allow_multiple is True:
+            return "" if self.allow_empty is True else None
+        if self.allow_multiple is True:
             response = split_escaped_comma_separated_string(response)
         else:
             response = (response,)
         if (
             response is None
             or len(response) == 0
-            or (allow_multiple is not True and len(response) > 1)
+            or (self.allow_multiple is not True and len(response) > 1)
         ):
-            response = None
-            clear_back_last_input()
-            continue
-        if data_type is bool:
-            continue_loop = False
-            normalised_response = list()
-            for response_item in response:
-                response_item_bool = normalise_value_to_YN(response_item)
-                if response_item_bool is None:
-                    continue_loop = True
-                    break
-                else:
-                    if (
-                        allow_repetitive is not True
-                        and response_item_bool in normalised_response
-                    ):
-                        continue_loop = True
-                        break
-                    else:
-                        normalised_response.append(response_item_bool)
-            if continue_loop is True:
-                response = None
-                clear_back_last_input()
-                continue
-            else:
-                response = tuple(normalised_response)
-                break
-        if options is None:
-            if data_type is not None:
+            return None
+        if self.data_type is bool:
+            normalised_response = tuple(map(normalise_value_to_YN, response))
+            if None in normalised_response:
+                return None
+            if self.allow_repetitive is not True and len(normalised_response) != len(
+                set(normalised_response)
+            ):
+                return None
+            return normalised_response
+        if self.options is None:
+            if self.data_type is not None:
                 try:
                     for response_item in response:
-                        data_type(response_item)
-                except:
-                    response = None
-                    clear_back_last_input()
-                    continue
-            if allow_repetitive is not True and len(response) != len(set(response)):
-                response = None
-                clear_back_last_input()
-                continue
-            break
+                        self.data_type(response_item)
+                except Exception:
+                    return None
+            if self.allow_repetitive is not True and len(response) != len(
+                set(response)
+            ):
+                return None
+            return response
+        response_options = list()
+        for response_item in response:
+            response_option = self.options.get(response_item)
+            if response_option is None:
+                return None
+            if self.option_validation == "lazy" and self.data_type is not None:
+                try:
+                    convert_value(self.data_type, response_option[0])
+                except Exception:
+                    return None
+            response_options.append(response_option)
+        if self.allow_repetitive is not True and len(response_options) != len(
+            set(response_options)
+        ):
+            return None
+        return response
+
+    def resolve_response(self, response, quiet=False):
+        if self.options is None:
+            response_value = response
         else:
-            if len(response) > 1 and allow_multiple is not True:
-                response = None
-                clear_back_last_input()
-                continue
-            response_options = list()
-            for response_item in response:
-                response_option = get_option(options, response_item)
-                if response_option is None:
-                    response = None
-                    clear_back_last_input()
-                    continue
+            response_options = tuple(
+                self.options.get(response_item) for response_item in response
+            )
+            response_value = tuple(
+                response_option[0] for response_option in response_options
+            )
+        if self.show_confirmation is True and quiet is not True:
+            if self.options is not None:
+                response_value_str = ", ".join(
+                    get_option_str(response_option, self.hide_key)
+                    for response_option in response_options
+                )
+            elif self.data_type is bool:
+                response_value_str = ", ".join(
+                    "Yes" if v == "Y" else "No" if v == "N" else "N/A"
+                    for v in response_value
+                )
+            else:
+                response_value_str = ", ".join(response_value)
+            print_formatted_confirmation(
+                self.prompt,
+                response_value_str,
+                self.hide_questionmark,
+                self.confirm_line_color,
+                self.prompt_io,
+            )
+        if len(response_value) == 1 and self.allow_multiple is not True:
+            response_value = response_value[0]
+        return response_value
+
+    def answer(self, answer, quiet=False):
+        if answer is None:
+            response = ""
+        elif isinstance(answer, bool):
+            response = "y" if answer is True else "n"
+        elif isinstance(answer, (list, tuple)):
+            response = ",".join(
+                quote_value(
+                    "y" if item is True else "n" if item is False else str(item)
+                )
+                for item in answer
+            )
+        else:
+            response = str(answer)
+        if quiet is not True:
+            self.print_options()
+            self.prompt_io.write_line(self.formatted_prompt + response)
+        parsed_response = self.parse_response(response)
+        if parsed_response is None:
+            self.prompt_io.flush()
+            raise ValueError(f"{self.prompt}: invalid answer {response!r}")
+        response_value = self.resolve_response(parsed_response, quiet=quiet)
+        if quiet is not True:
+            self.prompt_io.flush()
+        responses = self.start_recording()
+        if responses is not None:
+            responses.append(response)
+        return self.finish_response(response_value, responses)
+
+    def complete(self, text, state):
+        # readline completer: text is the segment after the last comma when
+        # allow_multiple is True, the whole line otherwise
+        if state == 0:
+            stripped_text = text.lstrip()
+            padding = text[: len(text) - len(stripped_text)]
+            if self.allow_multiple is True:
+                self.completions = [
+                    padding + quote_value(value)
+                    for value in self.options.complete(stripped_text)
+                ]
+            else:
+                self.completions = [
+                    padding + value for value in self.options.complete(stripped_text)
+                ]
+        if state < len(self.completions):
+            return self.completions[state]
+
+    def install_completer(self):
+        previous = (readline.get_completer(), readline.get_completer_delims())
+        readline.set_completer(self.complete)
+        readline.set_completer_delims("," if self.allow_multiple is True else "")
+        if "libedit" in (readline.__doc__ or ""):
+            readline.parse_and_bind("bind ^I rl_complete")
+        else:
+            readline.parse_and_bind("tab: complete")
+        return previous
+
+    def convert_response(self, response_value):
+        # strings are what history and confirmation use, so conversion is last
+        if (
+            self.return_converted is not True
+            or self.data_type is None
+            or response_value == ""
+        ):
+            return response_value
+        if self.data_type is bool:
+            convert = "Y".__eq__
+        elif self.options is None:
+            # typed answers are converted afresh, only options are memoised
+            convert = self.data_type
+        else:
+            convert = functools.partial(convert_value, self.data_type)
+        if isinstance(response_value, tuple):
+            return tuple(map(convert, response_value))
+        return convert(response_value)
+
+    def finish_response(self, response_value, responses=None):
+        if self.history is not None and response_value not in (None, ""):
+            self.history.record(self.prompt, self.options, response_value)
+        if responses is not None:
+            self.session_log.record(self, responses, response_value)
+        return self.convert_response(response_value)
+
+    def start_recording(self):
+        # the raw responses of one ask, retries and paging commands included
+        if isinstance(self.session_log, SessionRecorder):
+            return list()
+
+    def replay(self):
+        if isinstance(self.session_log, SessionReplayer):
+            response_value = self.session_log.replay(self)
+            if response_value is not None:
+                return self.convert_response(response_value)
+
+    def start_metrics(self):
+        if self.on_metrics is None:
+            return
+        metrics = PromptMetrics(self)
+        # compile time is only spent once, the first ask reports it
+        compile_times, self.compile_times = self.compile_times, (0.0, 0.0, 0.0)
+        metrics.resolve_time, metrics.validate_time, metrics.render_time = compile_times
+        return metrics
+
+    def finish_metrics(self, metrics, answered):
+        if metrics is not None:
+            metrics.finish(self, answered)
+            self.on_metrics(metrics)
+
+    def get_reader(self, responses=None):
+        if self.timeout is None and responses is None:
+            return self.prompt_io.input
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+
+        def read(prompt):
+            if self.timeout is None:
+                response = self.prompt_io.input(prompt)
+            else:
+                try:
+                    response = self.prompt_io.input(
+                        prompt, max(deadline - time.monotonic(), 0.0)
+                    )
+                except TimeoutError:
+                    response = self.time_out()
+            if responses is not None:
+                responses.append(response)
+            return response
+
+        return read
+
+    def get_async_reader(self, responses=None):
+        if self.timeout is None and responses is None:
+            return self.prompt_io.input_async
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+
+        async def read(prompt):
+            if self.timeout is None:
+                response = await self.prompt_io.input_async(prompt)
+            else:
+                try:
+                    response = await self.prompt_io.input_async(
+                        prompt, max(deadline - time.monotonic(), 0.0)
+                    )
+                except TimeoutError:
+                    response = self.time_out()
+            if responses is not None:
+                responses.append(response)
+            return response
+
+        return read
+
+    def time_out(self):
+        # the deadline covers the whole prompt including retries and paging
+        if self.default is None:
+            self.prompt_io.write_line()
+            raise TimeoutError(
+                f"{self.prompt}: no answer within {self.timeout} seconds"
+            )
+        self.prompt_io.write_line(self.formatted_default)
+        return ""
+
+    def ask(self):
+        replayed = self.replay()
+        if replayed is not None:
+            return replayed
+        metrics = self.start_metrics()
+        answered = False
+        responses = self.start_recording()
+        steps = self.prompt_steps(metrics)
+        if (
+            self.allow_completion is True
+            and self.options is not None
+            and readline is not None
+        ):
+            previous_completer, previous_delims = self.install_completer()
+            try:
+                response_value = run_prompt_steps(
+                    steps, self.get_reader(responses), metrics
+                )
+                answered = True
+                return self.finish_response(response_value, responses)
+            finally:
+                readline.set_completer(previous_completer)
+                readline.set_completer_delims(previous_delims)
+                self.prompt_io.flush()
+                self.finish_metrics(metrics, answered)
+        try:
+            response_value = run_prompt_steps(
+                steps, self.get_reader(responses), metrics
+            )
+            answered = True
+            return self.finish_response(response_value, responses)
+        finally:
+            self.prompt_io.flush()
+            self.finish_metrics(metrics, answered)
+
+    async def ask_async(self):
+        replayed = self.replay()
+        if replayed is not None:
+            return replayed
+        metrics = self.start_metrics()
+        answered = False
+        responses = self.start_recording()
+        try:
+            response_value = await run_prompt_steps_async(
+                self.prompt_steps(metrics), self.get_async_reader(responses), metrics
+            )
+            answered = True
+            return self.finish_response(response_value, responses)
+        finally:
+            self.prompt_io.flush()
+            self.finish_metrics(metrics, answered)
+
+    def prompt_steps(self, metrics=None):
+        # yields the formatted prompt whenever input is needed and expects the
+        # response to be sent back, so blocking and async readers share it
+        paging = self.page_size is not None and self.options is not None
+        searching = self.allow_search is True and self.options is not None
+        page = 0
+        matches = None
+        self.print_options()
+        while True:
+            if self.no_interaction is True and self.default is not None:
+                self.prompt_io.write_line(
+                    self.formatted_prompt + self.formatted_default
+                )
+                response = ""
+            else:
+                response = yield self.formatted_prompt
+            if searching and response.startswith("/"):
+                query = response[1:].strip()
+                page = 0
+                if query:
+                    matches = self.options.search(query)
+                    self.prompt_io.write_line(self.format_page(page, matches))
                 else:
-                    response_options.append(response_option)
-            if allow_repetitive is not True and len(response_options) != len(
-                set(response_options)
-            ):
-                response = None
-                clear_back_last_input()
+                    matches = None
+                    self.print_options()
                 continue
-    if options is None:
-        response_value = response
-        if data_type is bool:
-            response_value_str = ", ".join(
-                "Yes" if v == "Y" else "No" if v == "N" else "N/A"
-                for v in response_value
+            if paging:
+                new_page = parse_page_command(response, page)
+                if new_page is not None:
+                    formatted_page = (
+                        self.format_page(new_page, matches) if new_page >= 0 else None
+                    )
+                    if formatted_page is None:
+                        clear_back_last_input(self.prompt_io)
+                    else:
+                        page = new_page
+                        self.prompt_io.write_line(formatted_page)
+                    continue
+            if metrics is not None:
+                parse_started = time.perf_counter()
+            response = self.parse_response(response)
+            if metrics is not None:
+                metrics.parse_time += time.perf_counter() - parse_started
+            if response is not None:
+                break
+            clear_back_last_input(self.prompt_io)
+            if metrics is not None:
+                metrics.retries += 1
+        if metrics is None:
+            return self.resolve_response(response)
+        parse_started = time.perf_counter()
+        response_value = self.resolve_response(response)
+        metrics.parse_time += time.perf_counter() - parse_started
+        return response_value
+
+
+def run_prompt_steps(steps, read, metrics=None):
+    # with metrics, time spent in read() is waiting and the rest is rendering
+    # and parsing (the steps keep track of the parsing part)
+    try:
+        if metrics is None:
+            prompt = next(steps)
+            while True:
+                prompt = steps.send(read(prompt))
+        steps_started = time.perf_counter()
+        prompt = next(steps)
+        while True:
+            wait_started = time.perf_counter()
+            response = read(prompt)
+            metrics.wait_time += time.perf_counter() - wait_started
+            prompt = steps.send(response)
+    except StopIteration as stop:
+        return stop.value
+    finally:
+        if metrics is not None:
+            metrics.add_steps_time(time.perf_counter() - steps_started)
+
+
+async def run_prompt_steps_async(steps, read, metrics=None):
+    try:
+        if metrics is None:
+            prompt = next(steps)
+            while True:
+                prompt = steps.send(await read(prompt))
+        steps_started = time.perf_counter()
+        prompt = next(steps)
+        while True:
+            wait_started = time.perf_counter()
+            response = await read(prompt)
+            metrics.wait_time += time.perf_counter() - wait_started
+            prompt = steps.send(response)
+    except StopIteration as stop:
+        return stop.value
+    finally:
+        if metrics is not None:
+            metrics.add_steps_time(time.perf_counter() - steps_started)
+
+
+class PromptMetrics(object):
+    __slots__ = (
+        "prompt",
+        "started_at",
+        "resolve_time",
+        "validate_time",
+        "render_time",
+        "wait_time",
+        "parse_time",
+        "retries",
+        "option_count",
+        "bytes_written",
+        "answered",
+    )
+
+    def __init__(self, spec):
+        self.prompt = spec.prompt
+        self.started_at = time.time()
+        self.resolve_time = 0.0
+        self.validate_time = 0.0
+        self.render_time = 0.0
+        self.wait_time = 0.0
+        self.parse_time = 0.0
+        self.retries = 0
+        self.option_count = None
+        # the writer counter is read back in finish
+        self.bytes_written = spec.prompt_io.writer.bytes_written
+        self.answered = False
+
+    def add_steps_time(self, steps_time):
+        self.render_time += steps_time - self.wait_time - self.parse_time
+
+    def finish(self, spec, answered):
+        self.answered = answered
+        if spec.options is not None:
+            # a lazy source only counts the options pulled so far
+            self.option_count = (
+                len(spec.options.options)
+                if isinstance(spec.options, LazyOptionSet)
+                else len(spec.options)
             )
-        else:
-            response_value_str = ", ".join(response_value)
-    else:
-        response_options = tuple(
-            get_option(options, response_item) for response_item in response
-        )
-        response_value = tuple(
-            response_option[0] for response_option in response_options
+        self.bytes_written = spec.prompt_io.writer.bytes_written - self.bytes_written
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class JsonLinesMetricsExporter(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, metrics):
+        line = json.dumps(metrics.as_dict()) + "\n"
+        with self.lock:
+            with open(self.path, "a") as metrics_file:
+                metrics_file.write(line)
+
+
+class AsyncLineReader(object):
+    # reads a line with a deadline or without blocking the event loop, never
+    # more than the stream itself would: whatever the stream holds is taken
+    # first and its descriptor is only read without blocking once select()
+    # or the loop says it is ready, so the script's own reads of the stream
+    # still find the lines after the prompt's answer
+    def __init__(self, stream):
+        self.stream = stream
+        try:
+            self.fd = stream.fileno()
+        except (AttributeError, OSError, ValueError):
+            self.fd = None
+        self.watchable = self.fd is not None
+        # a line typed in part before it is complete
+        self.partial = ""
+
+    def read_ready(self, readable):
+        # returns the line or None if it is not complete yet, readable is
+        # True if the descriptor was reported ready to read
+        blocking = os.get_blocking(self.fd)
+        os.set_blocking(self.fd, False)
+        try:
+            text = self.stream.readline()
+        except (BlockingIOError, TypeError):
+            text = ""
+        finally:
+            os.set_blocking(self.fd, blocking)
+        if text.endswith("\n"):
+            return self.take_line(text)
+        self.partial += text
+        if text or not readable:
+            return None
+        # ready but nothing to read: end of input
+        return self.take_line("")
+
+    def take_line(self, text):
+        line, self.partial = self.partial + text, ""
+        if not line:
+            raise EOFError
+        return line[:-1] if line.endswith("\n") else line
+
+    async def wait_readable(self):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        try:
+            loop.add_reader(
+                self.fd, lambda: readable.done() or readable.set_result(None)
+            )
+        except (NotImplementedError, OSError):
+            # e.g. regular files under epoll or the Windows proactor loop
+            self.watchable = False
+            return
+        try:
+            await readable
+        finally:
+            loop.remove_reader(self.fd)
+
+    async def readline(self):
+        if self.fd is not None:
+            line = self.read_ready(False)
+            while line is None and self.watchable:
+                await self.wait_readable()
+                if self.watchable:
+                    line = self.read_ready(True)
+            if line is not None:
+                return line
+        text = await asyncio.get_running_loop().run_in_executor(
+            None, self.stream.readline
         )
-        response_value_str = ", ".join(
-            get_option_str(response_option, hide_key)
-            for response_option in response_options
+        return self.take_line(text)
+
+    def readline_before(self, deadline):
+        # blocking read that gives up at deadline (a time.monotonic() value),
+        # waiting in select() instead of polling
+        if self.fd is None:
+            return self.take_line(self.stream.readline())
+        line = self.read_ready(False)
+        while line is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError
+            try:
+                readable = select.select([self.fd], [], [], remaining)[0]
+            except (OSError, ValueError):
+                # not selectable, e.g. a Windows console: wait without
+                # deadline
+                return self.take_line(self.stream.readline())
+            if readable:
+                line = self.read_ready(True)
+        return line
+
+    def discard_pending(self):
+        # input typed before a deadline passed must not answer the next prompt
+        self.partial = ""
+        if termios is not None and self.fd is not None and os.isatty(self.fd):
+            termios.tcflush(self.fd, termios.TCIFLUSH)
+
+
+ASYNC_LINE_READERS = weakref.WeakKeyDictionary()
+
+
+def get_async_line_reader(stream):
+    line_reader = ASYNC_LINE_READERS.get(stream)
+    if line_reader is None:
+        line_reader = AsyncLineReader(stream)
+        ASYNC_LINE_READERS[stream] = line_reader
+    return line_reader
+
+
+class BufferedWriter(object):
+    # collects the writes of a render cycle and hands them to the stream in
+    # one write when the cycle is flushed
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.chunks = list()
+        self.bytes_written = 0
+
+    def write(self, text):
+        self.chunks.append(text)
+
+    def flush(self):
+        stream = sys.stdout if self.stream is None else self.stream
+        if self.chunks:
+            text = "".join(self.chunks)
+            self.chunks.clear()
+            stream.write(text)
+            self.count(text)
+        stream.flush()
+
+    def count(self, text):
+        # isascii() is O(1) on str, only non-ASCII output gets encoded
+        self.bytes_written += (
+            len(text) if text.isascii() else len(text.encode("utf-8", "replace"))
         )
-    if show_confirmation is True:
-        print_formatted_confirmation(
-            prompt, response_value_str, hide_questionmark, confirm_line_color
+
+
+class PromptIO(object):
+    # reads lines from reader and writes to writer, sys.stdin and sys.stdout
+    # (looked up on use) if not given
+    def __init__(self, reader=None, writer=None):
+        self.reader = reader
+        self.writer = BufferedWriter(writer)
+
+    def get_reader(self):
+        return sys.stdin if self.reader is None else self.reader
+
+    def write(self, text):
+        self.writer.write(text)
+
+    def write_line(self, text=""):
+        self.writer.write(f"{text}\n")
+
+    def flush(self):
+        self.writer.flush()
+
+    def input(self, prompt="", timeout=None):
+        self.write(prompt)
+        self.flush()
+        if timeout is None:
+            line = self.get_reader().readline()
+            if not line:
+                raise EOFError
+            return line[:-1] if line.endswith("\n") else line
+        line_reader = get_async_line_reader(self.get_reader())
+        try:
+            return line_reader.readline_before(time.monotonic() + timeout)
+        except TimeoutError:
+            line_reader.discard_pending()
+            raise
+
+    async def input_async(self, prompt="", timeout=None):
+        self.write(prompt)
+        self.flush()
+        line_reader = get_async_line_reader(self.get_reader())
+        if timeout is None:
+            return await line_reader.readline()
+        try:
+            return await asyncio.wait_for(line_reader.readline(), timeout)
+        except asyncio.TimeoutError:
+            line_reader.discard_pending()
+            raise TimeoutError
+
+
+class TTYPromptIO(PromptIO):
+    # the builtin input() keeps readline editing, history and completion,
+    # reads with a timeout go through select() and do without them
+    def input(self, prompt="", timeout=None):
+        if timeout is not None:
+            return super().input(prompt, timeout)
+        self.flush()
+        self.writer.count(prompt)
+        return input(prompt)
+
+
+class MemoryPromptIO(PromptIO):
+    def __init__(self, text=""):
+        super().__init__(io.StringIO(text), io.StringIO())
+
+    def getvalue(self):
+        self.flush()
+        return self.writer.stream.getvalue()
+
+
+DEFAULT_PROMPT_IO = TTYPromptIO()
+
+
+class AnswerHistory(object):
+    # accepted answers keyed by prompt and options fingerprint, appended to a
+    # JSON lines log that is read in one go when opened and rewritten with
+    # the live entries once it holds twice as many lines
+    def __init__(self, path, max_entries=1000):
+        if (
+            not isinstance(max_entries, int)
+            or isinstance(max_entries, bool)
+            or max_entries < 1
+        ):
+            raise TypeError("max_entries: positive int expected")
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.log_lines = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        try:
+            with open(self.path) as history_file:
+                text = history_file.read()
+        except FileNotFoundError:
+            return
+        for line in text.splitlines():
+            try:
+                record = json.loads(line)
+                key = (record["prompt"], record["options"])
+                answer = record["answer"]
+            except (ValueError, KeyError, TypeError):
+                # blank or torn lines, e.g. from an interrupted write
+                continue
+            self.entries[key] = answer
+            self.entries.move_to_end(key)
+            self.log_lines += 1
+        self.evict()
+        if self.log_lines > 2 * self.max_entries:
+            self.compact()
+
+    def evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, prompt, options=None):
+        key = (prompt, None if options is None else options.fingerprint())
+        answer = self.entries.get(key)
+        if answer is not None:
+            self.entries.move_to_end(key)
+        return answer
+
+    def record(self, prompt, options, answer):
+        if isinstance(answer, tuple):
+            answer = list(answer)
+        key = (prompt, None if options is None else options.fingerprint())
+        line = json.dumps({"prompt": key[0], "options": key[1], "answer": answer})
+        with self.lock:
+            self.entries[key] = answer
+            self.entries.move_to_end(key)
+            self.evict()
+            with open(self.path, "a") as history_file:
+                history_file.write(line + "\n")
+            self.log_lines += 1
+            if self.log_lines > 2 * self.max_entries:
+                self.compact()
+
+    def compact(self):
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as history_file:
+            for (prompt, options), answer in self.entries.items():
+                history_file.write(
+                    json.dumps({"prompt": prompt, "options": options, "answer": answer})
+                    + "\n"
+                )
+        os.replace(temporary_path, self.path)
+        self.log_lines = len(self.entries)
+
+
+def get_options_fingerprint(options):
+    return None if options is None else options.fingerprint()
+
+
+def get_json_value(value):
+    # the value as it reads back from JSON, e.g. tuples become lists
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    return json.loads(json.dumps(value, default=str))
+
+
+class SessionRecorder(object):
+    # one compact JSON line per answered prompt: the prompt, what identifies
+    # its options and default, the raw responses and the resolved answer
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.log_file = open(path, "a", buffering=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.log_file.close()
+
+    def record(self, spec, responses, response_value):
+        line = json.dumps(
+            {
+                "prompt": spec.prompt,
+                "options": get_options_fingerprint(spec.options),
+                "default": get_json_value(spec.default),
+                "responses": responses,
+                "value": response_value,
+            },
+            separators=(",", ":"),
+            default=str,
         )
-    if len(response_value) == 1 and allow_multiple is not True:
-        response_value = response_value[0]
-    return response_value
+        with self.lock:
+            self.log_file.write(line + "\n")
+
+
+class SessionReplayer(object):
+    # answers prompts from a recorded session without any input or output;
+    # prompts past the end of the log are asked as usual
+    def __init__(self, path, strict=False):
+        with open(path) as log_file:
+            text = log_file.read()
+        self.records = [json.loads(line) for line in text.splitlines() if line]
+        self.position = 0
+        self.strict = strict
+        self.drift = list()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def exhausted(self):
+        return self.position >= len(self.records)
+
+    def report(self, message):
+        self.drift.append(message)
+        if self.strict is True:
+            raise ValueError(message)
+
+    def replay(self, spec):
+        with self.lock:
+            if self.position >= len(self.records):
+                return
+            number = self.position + 1
+            record = self.records[self.position]
+            self.position += 1
+        changes = list()
+        if record["prompt"] != spec.prompt:
+            changes.append(f"prompt was {record['prompt']!r}")
+        if record["options"] != get_options_fingerprint(spec.options):
+            changes.append("options changed")
+        if record["default"] != get_json_value(spec.default):
+            changes.append(f"default was {record['default']!r}")
+        if changes:
+            self.report(f"#{number} {spec.prompt}: {', '.join(changes)}")
+        searching = spec.allow_search is True and spec.options is not None
+        paging = spec.page_size is not None and spec.options is not None
+        # no_interaction prompts take the default without reading anything
+        for response in record["responses"] or ("",):
+            if searching and response.startswith("/"):
+                continue
+            if paging and parse_page_command(response, 0) is not None:
+                continue
+            parsed_response = spec.parse_response(response)
+            if parsed_response is not None:
+                break
+        else:
+            message = f"#{number} {spec.prompt}: recorded answers are invalid"
+            self.drift.append(message)
+            raise ValueError(message)
+        response_value = spec.resolve_response(parsed_response, quiet=True)
+        recorded_value = record["value"]
+        if get_json_value(response_value) != recorded_value:
+            self.report(
+                f"#{number} {spec.prompt}: answer is {response_value!r},"
+                f" recorded {recorded_value!r}"
+            )
+        return response_value
+
+
+def compile_prompt(
+    prompt=None,
+    options=None,
+    data_type=None,
+    default=None,
+    allow_empty=None,
+    allow_multiple=None,
+    allow_repetitive=None,
+    show_confirmation=None,
+    hide_key=None,
+    hide_questionmark=None,
+    hide_mandatory_sign=None,
+    hide_multiple_choice_sign=None,
+    no_interaction=None,
+    options_line_color=None,
+    options_number_color=None,
+    input_line_color=None,
+    confirm_line_color=None,
+    page_size=None,
+    allow_search=None,
+    allow_completion=None,
+    prompt_io=None,
+    on_metrics=None,
+    history=None,
+    option_validation=None,
+    return_converted=None,
+    timeout=None,
+    session_log=None,
+):
+    started = time.perf_counter()
+    arguments = resolve_defaults(locals(), ARGUMENT_NAMES)
+    resolved = time.perf_counter()
+    arguments["options"] = validate_arguments(**arguments)
+    history = arguments["history"]
+    if history is not None and arguments["default"] is None:
+        remembered = history.get(arguments["prompt"], arguments["options"])
+        if remembered is not None:
+            try:
+                validate_default(
+                    remembered,
+                    arguments["options"],
+                    arguments["data_type"],
+                    arguments["allow_empty"],
+                    arguments["allow_multiple"],
+                    arguments["allow_repetitive"],
+                )
+            except TypeError:
+                # the options changed in a way the fingerprint cannot tell
+                pass
+            else:
+                arguments["default"] = remembered
+    validated = time.perf_counter()
+    spec = PromptSpec(arguments)
+    spec.compile_times = (
+        resolved - started,
+        validated - resolved,
+        time.perf_counter() - validated,
+    )
+    return spec
+
+
+def promptwithoptions(
+    prompt=None,
+    options=None,
+    data_type=None,
+    default=None,
+    allow_empty=None,
+    allow_multiple=None,
+    allow_repetitive=None,
+    show_confirmation=None,
+    hide_key=None,
+    hide_questionmark=None,
+    hide_mandatory_sign=None,
+    hide_multiple_choice_sign=None,
+    no_interaction=None,
+    options_line_color=None,
+    options_number_color=None,
+    input_line_color=None,
+    confirm_line_color=None,
+    page_size=None,
+    allow_search=None,
+    allow_completion=None,
+    prompt_io=None,
+    on_metrics=None,
+    history=None,
+    option_validation=None,
+    return_converted=None,
+    timeout=None,
+    session_log=None,
+):
+    return compile_prompt(**locals()).ask()
+
+
+def load_answers(answers):
+    if answers is None or isinstance(answers, dict):
+        return answers or dict()
+    if isinstance(answers, str):
+        with open(answers) as answers_file:
+            text = answers_file.read()
+    else:
+        text = answers.read()
+    try:
+        loaded_answers = json.loads(text)
+    except ValueError:
+        # JSON lines, each holding one or more answers
+        loaded_answers = dict()
+        for line in text.splitlines():
+            if line.strip():
+                loaded_answers.update(json.loads(line))
+    if not isinstance(loaded_answers, dict):
+        raise TypeError("answers: JSON object expected")
+    return loaded_answers
+
+
+def run_form(specs, answers=None, quiet=None):
+    answers = load_answers(answers)
+    results = dict()
+    for spec in specs:
+        if isinstance(spec, PromptSpec):
+            name = spec.prompt
+        elif isinstance(spec, dict):
+            spec = dict(spec)
+            name = spec.pop("name", spec.get("prompt"))
+            spec = compile_prompt(**spec)
+        else:
+            raise TypeError("specs: PromptSpec or dict expected")
+        results[name] = spec.answer(answers.get(name), quiet=quiet)
+    return results
+
+
+async def async_promptwithoptions(
+    prompt=None,
+    options=None,
+    data_type=None,
+    default=None,
+    allow_empty=None,
+    allow_multiple=None,
+    allow_repetitive=None,
+    show_confirmation=None,
+    hide_key=None,
+    hide_questionmark=None,
+    hide_mandatory_sign=None,
+    hide_multiple_choice_sign=None,
+    no_interaction=None,
+    options_line_color=None,
+    options_number_color=None,
+    input_line_color=None,
+    confirm_line_color=None,
+    page_size=None,
+    allow_search=None,
+    allow_completion=None,
+    prompt_io=None,
+    on_metrics=None,
+    history=None,
+    option_validation=None,
+    return_converted=None,
+    timeout=None,
+    session_log=None,
+):
+    return await compile_prompt(**locals()).ask_async()
@@ -0,0 +1,139 @@
+import sys
+import asyncio
+import argparse
+
+from .promptwithoptions import (
+    PromptIO,
+    prompt_defaults,
+    async_promptwithoptions,
+    get_async_line_reader,
+)
+
+
+class StreamWriterAdapter(object):
+    def __init__(self, writer, encoding="utf-8"):
+        self.writer = writer
+        self.encoding = encoding
+
+    def write(self, text):
+        self.writer.write(text.encode(self.encoding))
+
+    def flush(self):
+        pass
+
+
+class SocketPromptIO(PromptIO):
+    def __init__(self, reader, writer, encoding="utf-8"):
+        super().__init__(None, StreamWriterAdapter(writer, encoding))
+        self.stream_reader = reader
+        self.stream_writer = writer
+        self.encoding = encoding
+
+    def input(self, prompt="", timeout=None):
+        raise RuntimeError("prompt_io: socket sessions can only be asked async")
+
+    async def input_async(self, prompt="", timeout=None):
+        self.write(prompt)
+        self.flush()
+        await self.stream_writer.drain()
+        try:
+            line = await asyncio.wait_for(self.stream_reader.readline(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError
+        if not line:
+            raise EOFError
+        return line.decode(self.encoding).rstrip("\r\n")
+
+
+class PromptSession(object):
+    def __init__(self, reader, writer):
+        self.prompt_io = SocketPromptIO(reader, writer)
+        self.peer = writer.get_extra_info("peername")
+
+    async def ask(self, *args, **kwargs):
+        kwargs.setdefault("prompt_io", self.prompt_io)
+        return await async_promptwithoptions(*args, **kwargs)
+
+    def write_line(self, text=""):
+        self.prompt_io.write_line(text)
+        self.prompt_io.flush()
+
+
+async def handle_session(handler, reader, writer):
+    session = PromptSession(reader, writer)
+    try:
+        # every connection runs in its own task, so defaults set by the
+        # handler stay within the session
+        with prompt_defaults(prompt_io=session.prompt_io):
+            await handler(session)
+        await writer.drain()
+    except (EOFError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(handler, host=None, port=None, path=None, **server_kwargs):
+    def on_connect(reader, writer):
+        return handle_session(handler, reader, writer)
+
+    if path is not None:
+        return await asyncio.start_unix_server(on_connect, path=path, **server_kwargs)
+    return await asyncio.start_server(on_connect, host=host, port=port, **server_kwargs)
+
+
+async def open_connection(host=None, port=None, path=None):
+    if path is not None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(host, port)
+
+
+async def run_client(host=None, port=None, path=None):
+    reader, writer = await open_connection(host, port, path)
+
+    async def relay_output():
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            sys.stdout.write(data.decode("utf-8", "replace"))
+            sys.stdout.flush()
+
+    async def relay_input():
+        line_reader = get_async_line_reader(sys.stdin)
+        while True:
+            try:
+                line = await line_reader.readline()
+            except EOFError:
+                writer.write_eof()
+                break
+            writer.write(f"{line}\n".encode("utf-8"))
+            await writer.drain()
+
+    input_task = asyncio.ensure_future(relay_input())
+    try:
+        await relay_output()
+    finally:
+        input_task.cancel()
+        writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m promptwithoptions.server",
+        description="Connect the terminal to a promptwithoptions prompt server",
+    )
+    parser.add_argument("--path", help="unix socket path")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int)
+    args = parser.parse_args(argv)
+    if args.path is None and args.port is None:
+        parser.error("--path or --port is required")
+    try:
+        asyncio.run(run_client(args.host, args.port, args.path))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
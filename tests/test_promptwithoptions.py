@@ -1,10 +1,44 @@
+import asyncio
+import concurrent.futures
+import gc
+import io
+import itertools
+import json
+import os
+import sys
+import time
+import weakref
+
 import pytest
 
 from promptwithoptions import (
     set_prompt_defaults,
     reset_prompt_defaults,
+    prompt_defaults,
     promptwithoptions,
+    async_promptwithoptions,
+    compile_prompt,
+    OptionSet,
+    CompactOptionSet,
+    FileOptionSet,
+    OptionProvider,
+    cached_options,
+    PromptIO,
+    MemoryPromptIO,
+    JsonLinesMetricsExporter,
+    AnswerHistory,
+    SessionRecorder,
+    SessionReplayer,
+    run_form,
+)
+from promptwithoptions.promptwithoptions import (
+    get_option,
+    normalise_options,
+    split_escaped_comma_separated_string,
 )
+from promptwithoptions.cli import load_request, serve_requests, main as cli_main
+
+pwo_module = sys.modules[get_option.__module__]
 
 def test_set_prompt_defaults_prompt():
     reset_prompt_defaults()
@@ -142,3 +176,599 @@ def test_promptwithoptions():
     reset_prompt_defaults()
     with pytest.raises(TypeError):
         promptwithoptions(options=8)
+
+def test_option_set_lookup():
+    option_set = OptionSet(normalise_options({1: 'Header', 2: 'Main area', '': 'Default'}))
+    assert option_set.get(2) == ('2', 'Main area')
+    assert option_set.get('Main area') == ('2', 'Main area')
+    assert option_set.get('') == ('', 'Default')
+    assert option_set.get('Footer') is None
+    assert option_set.ambiguous_refs == set()
+
+def test_option_set_matches_linear_lookup():
+    options = normalise_options((('a', 'x'), ('b', 'a'), ('3', 'c'), ('1', 'd')))
+    option_set = OptionSet(options)
+    for ref in ('a', 'x', 'b', 'c', 'd', 1, '3', '4', 'y'):
+        assert get_option(option_set, ref) == get_option(options, ref)
+    assert option_set.ambiguous_refs == {'a', '1'}
+
+def test_compact_option_set_matches_option_set():
+    options = (('a', 'x'), ('b', 'a'), ('3', 'c'), ('1', 'd'), ('é', ''), ('b', 'a'), '+2')
+    option_set = OptionSet(normalise_options(options))
+    compact_option_set = CompactOptionSet(options)
+    assert list(compact_option_set) == list(option_set)
+    assert compact_option_set[-2:] == option_set[-2:]
+    assert compact_option_set.keys() == option_set.keys()
+    assert compact_option_set.ambiguous_refs == option_set.ambiguous_refs
+    assert compact_option_set.fingerprint() == option_set.fingerprint()
+    for ref in ('a', 'x', 'b', 'c', 'd', 1, '3', '4', 'y', 'é', '', '+2', '-1'):
+        assert compact_option_set.get(ref) == option_set.get(ref)
+    assert compact_option_set.complete('b') == option_set.complete('b')
+
+def test_compact_options_prompt(monkeypatch):
+    reset_prompt_defaults()
+    monkeypatch.setattr(pwo_module, 'COMPACT_OPTIONS_MIN_SIZE', 3)
+    spec = compile_prompt('Pick', options={'a': 'Alpha', 'b': 'Beta', 'c': 'Gamma'}, default='b', allow_search=True, page_size=2)
+    assert isinstance(spec.options, CompactOptionSet)
+    prompt_io = MemoryPromptIO('/mm\n>\nGamma\n')
+    spec.prompt_io = prompt_io
+    assert spec.ask() == 'c'
+    assert '3 > c - Gamma' in prompt_io.getvalue()
+    assert spec.formatted_prompt == 'Pick?* (b - Beta) '
+
+def test_file_option_set(tmp_path):
+    options = (('a', 'x'), ('b', 'a'), ('3', 'c, d'), ('1', 'é'))
+    option_set = OptionSet(normalise_options(options))
+    csv_path = tmp_path / 'options.csv'
+    csv_path.write_text('key,label\na,x\nb,a\n\n3,"c, d"\r\n1,é', encoding='utf-8')
+    jsonl_path = tmp_path / 'options.jsonl'
+    jsonl_path.write_text('["a", "x"]\n{"key": "b", "label": "a"}\n["3", "c, d"]\n["1", "é"]\n')
+    tsv_path = tmp_path / 'options.tsv'
+    tsv_path.write_text('a\tx\nb\ta\n3\tc, d\n1\té\n')
+    for path, header in ((csv_path, True), (jsonl_path, False), (tsv_path, False)):
+        for _ in range(2):
+            file_option_set = FileOptionSet(str(path), header=header)
+            assert list(file_option_set) == list(option_set)
+            assert file_option_set.ambiguous_refs == option_set.ambiguous_refs
+            for ref in ('a', 'x', 'b', 'c, d', 1, '3', '4', 'é', 'y'):
+                assert file_option_set.get(ref) == option_set.get(ref)
+        assert os.path.exists(f'{path}.pwoidx')
+    # a changed file is indexed again
+    tsv_path.write_text('z\tzed\n')
+    assert FileOptionSet(str(tsv_path)).get('zed') == ('z', 'zed')
+    assert promptwithoptions('Pick', options=FileOptionSet(str(csv_path), header=True), page_size=2, prompt_io=MemoryPromptIO('c, d\n')) == '3'
+    latin_path = tmp_path / 'latin.tsv'
+    latin_path.write_bytes('a\tcaf\xe9\n'.encode('latin-1'))
+    latin_option_set = FileOptionSet(str(latin_path), encoding='latin-1')
+    assert latin_option_set.get('café') == ('a', 'café') and latin_option_set.get('€') is None
+    assert promptwithoptions('Pick', options=latin_option_set, prompt_io=MemoryPromptIO('€\ncafé\n')) == 'a'
+    with pytest.raises(TypeError):
+        FileOptionSet(str(csv_path), format='xml')
+
+def test_option_provider(monkeypatch):
+    calls = []
+
+    @cached_options(ttl=60, max_entries=2)
+    def refs(prefix='o'):
+        calls.append(prefix)
+        return (f'{prefix}{i}' for i in range(5))
+
+    assert refs.__name__ == 'refs'
+    assert promptwithoptions('Ref', options=refs, prompt_io=MemoryPromptIO('2\n')) == 'o1'
+    assert promptwithoptions('Ref', options=refs, allow_search=True, prompt_io=MemoryPromptIO('o4\n')) == 'o4'
+    assert refs() is refs()
+    assert promptwithoptions('Ref', options=refs('r'), prompt_io=MemoryPromptIO('r3\n')) == 'r3'
+    assert calls == ['o', 'r']
+    refs('s')
+    assert refs.stats()['evictions'] == 1 and len(refs.entries) == 2
+    refs.invalidate('r')
+    refs('r')
+    assert calls == ['o', 'r', 's', 'r']
+    stats = refs.stats()
+    assert (stats['hits'], stats['misses'], stats['builds'], stats['invalidations']) == (3, 4, 4, 1)
+    monkeypatch.setattr(pwo_module.time, 'monotonic', lambda: 1e12)
+    refs('r')
+    assert refs.stats()['expirations'] == 1 and calls[-1] == 'r'
+    refs.invalidate()
+    assert refs.stats()['entries'] == 0
+    slow = OptionProvider(lambda: time.sleep(0.05) or ['a', 'b'])
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        assert len(set(map(id, executor.map(lambda _: slow(), range(8))))) == 1
+    assert slow.stats()['builds'] == 1 and slow.stats()['hits'] == 7
+    with pytest.raises(TypeError):
+        OptionProvider(refs, ttl=0)
+    with pytest.raises(TypeError):
+        promptwithoptions('Ref', options=OptionProvider(lambda: 3), prompt_io=MemoryPromptIO('1\n'))
+
+
+def feed_input(monkeypatch, *responses):
+    responses = iter(responses)
+    monkeypatch.setattr('builtins.input', lambda prompt='': next(responses))
+
+def test_promptwithoptions_responses(monkeypatch):
+    reset_prompt_defaults()
+    options = {1: 'Header', 2: 'Main area', '': 'Default'}
+    feed_input(monkeypatch, 'x', 'Main area')
+    assert promptwithoptions('Zone', options=options) == '2'
+    feed_input(monkeypatch, '')
+    assert promptwithoptions('Zones', options=options, default=(1, 2), allow_multiple=True) == ('1', '2')
+    feed_input(monkeypatch, 'y,y', 'y,n')
+    assert promptwithoptions('Bools', data_type=bool, allow_multiple=True) == ('Y', 'N')
+    feed_input(monkeypatch, 'x', '12')
+    assert promptwithoptions('Number', data_type=int) == '12'
+
+def test_compile_prompt(monkeypatch):
+    reset_prompt_defaults()
+    set_prompt_defaults(hide_questionmark=True)
+    spec = compile_prompt('Colour', options=('red', 'green'), default='green')
+    reset_prompt_defaults()
+    assert spec.formatted_prompt == 'Colour* (green) '
+    feed_input(monkeypatch, '', '1', 'green')
+    assert [spec.ask() for _ in range(3)] == ['green', 'red', 'green']
+    with pytest.raises(TypeError):
+        compile_prompt('Colour', options=('red', 'green'), default='blue')
+
+def test_compile_prompt_normalises_options_once(monkeypatch):
+    reset_prompt_defaults()
+    calls = list()
+    monkeypatch.setattr(
+        pwo_module,
+        'normalise_options',
+        lambda options: calls.append(options) or normalise_options(options),
+    )
+    options = tuple(f'key{i}' for i in range(100))
+    spec = compile_prompt('Keys', options=options, default=options[:50], allow_multiple=True)
+    assert len(calls) == 1
+    assert spec.parse_response('') == options[:50]
+
+def test_lazy_options():
+    reset_prompt_defaults()
+    with pytest.raises(TypeError):
+        set_prompt_defaults(options=lambda: ('x', 'y'), data_type=int, default='x')
+    pulled = list()
+    def hosts():
+        for i in itertools.count(1):
+            pulled.append(i)
+            yield (f'host{i}', f'Host {i}')
+    spec = compile_prompt('Host', options=hosts(), default='host3')
+    assert len(pulled) == 3
+    assert spec.parse_response('25') == ('25',)
+    assert spec.resolve_response(('25',)) == 'host25'
+    assert spec.parse_response('Host 40') == ('Host 40',)
+    assert len(pulled) == 40
+
+def test_lazy_options_provider(monkeypatch, capsys):
+    reset_prompt_defaults()
+    feed_input(monkeypatch, 'b')
+    assert promptwithoptions('Pick', options=lambda: {'a': 'A', 'b': 'B'}) == 'b'
+    assert capsys.readouterr().out == '1 > a - A\n2 > b - B\n'
+
+def test_page_size(monkeypatch, capsys):
+    reset_prompt_defaults()
+    with pytest.raises(TypeError):
+        set_prompt_defaults(page_size=0)
+    feed_input(monkeypatch, '>', '>9', '>3', '<', '7')
+    assert promptwithoptions('Pick', options=[f'o{i}' for i in range(1, 8)], page_size=3) == 'o7'
+    assert capsys.readouterr().out.split('\n') == [
+        '1 > o1', '2 > o2', '3 > o3', "page 1 of 3 - '<' previous, '>' next, '>N' page N",
+        '4 > o4', '5 > o5', '6 > o6', "page 2 of 3 - '<' previous, '>' next, '>N' page N",
+        '\x1b[F\x1b[K7 > o7', "page 3 of 3 - '<' previous, '>' next, '>N' page N",
+        '4 > o4', '5 > o5', '6 > o6', "page 2 of 3 - '<' previous, '>' next, '>N' page N",
+        '',
+    ]
+
+def test_page_size_pulls_only_the_page(monkeypatch):
+    reset_prompt_defaults()
+    pulled = list()
+    def hosts():
+        for i in itertools.count(1):
+            pulled.append(i)
+            yield f'host{i}'
+    feed_input(monkeypatch, '>', '6')
+    assert promptwithoptions('Host', options=hosts(), page_size=3) == 'host6'
+    assert len(pulled) == 7
+
+def test_option_search_index():
+    option_set = OptionSet(normalise_options([f'prod-eu-{i}' for i in range(50)] + ['prod-us-1', 'dev-eu-1']))
+    assert option_set.search('PROD-EU-1') == [1] + list(range(10, 20))
+    assert option_set.search('prod-eu-17') == [17]
+    assert option_set.search('eu-1') == [1] + list(range(10, 20)) + [51]
+    assert option_set.search('us') == [50]
+    assert option_set.search('xyz') == []
+
+def test_allow_search(monkeypatch, capsys):
+    reset_prompt_defaults()
+    options = {'h1': 'prod-eu', 'h2': 'prod-us', 'h3': 'dev-eu'}
+    feed_input(monkeypatch, '/eu', '/', '/-us', '2')
+    assert promptwithoptions('Host', options=options, allow_search=True, hide_key=True) == 'h2'
+    assert capsys.readouterr().out.split('\n') == [
+        '1 > prod-eu', '2 > prod-us', '3 > dev-eu',
+        '1 > prod-eu', '3 > dev-eu', "2 found, '/' shows all",
+        '1 > prod-eu', '2 > prod-us', '3 > dev-eu',
+        '2 > prod-us', "1 found, '/' shows all",
+        '',
+    ]
+
+def test_completion_trie():
+    option_set = OptionSet(normalise_options({'prod-eu-1': 'Paris', 'prod-eu-2': 'Dublin', 'prod-us-1': 'Ohio', 'p': 'Pune'}))
+    assert option_set.complete('prod-e') == ['prod-eu-1', 'prod-eu-2']
+    assert option_set.complete('prod') == ['prod-eu-1', 'prod-eu-2', 'prod-us-1']
+    assert option_set.complete('P') == ['Paris', 'Pune']
+    assert option_set.complete('prod-eu-3') == []
+    assert option_set.complete('prod-eu-1x') == []
+    assert len(option_set.complete('')) == 8
+
+def test_completer():
+    reset_prompt_defaults()
+    spec = compile_prompt('Hosts', options=('prod-eu', 'prod-us', 'a,b'), allow_multiple=True)
+    assert [spec.complete(' prod', state) for state in range(3)] == [' prod-eu', ' prod-us', None]
+    assert spec.complete('a', 0) == '"a,b"'
+
+def test_run_form(capsys):
+    reset_prompt_defaults()
+    specs = [
+        {'name': 'zone', 'prompt': 'Zone', 'options': {1: 'Header', 2: 'Footer'}},
+        {'name': 'hosts', 'prompt': 'Hosts', 'allow_multiple': True},
+        compile_prompt('Retry', data_type=bool, default='y'),
+    ]
+    answers = io.StringIO('{"zone": "Footer"}\n{"hosts": ["a", "b,c"]}\n')
+    assert run_form(specs, answers, quiet=True) == {'zone': '2', 'hosts': ('a', 'b,c'), 'Retry': 'Y'}
+    assert capsys.readouterr().out == ''
+    assert run_form(specs[:1], {'zone': 1}) == {'zone': '1'}
+    assert capsys.readouterr().out == '1 > 1 - Header\n2 > 2 - Footer\nZone?* 1\n'
+    with pytest.raises(ValueError):
+        run_form(specs, {'zone': 3}, quiet=True)
+
+def test_async_promptwithoptions(monkeypatch):
+    reset_prompt_defaults()
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(read_fd) as stdin:
+        monkeypatch.setattr('sys.stdin', stdin)
+        async def answer_later():
+            await asyncio.sleep(0.01)
+            os.write(write_fd, b'x\n2\n')
+        async def heartbeat(beats):
+            while True:
+                beats.append(1)
+                await asyncio.sleep(0.001)
+        async def main():
+            beats = list()
+            heartbeat_task = asyncio.ensure_future(heartbeat(beats))
+            asyncio.ensure_future(answer_later())
+            result = await async_promptwithoptions('Pick', options=('a', 'b'))
+            heartbeat_task.cancel()
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(compile_prompt('Pick', options=('a', 'b')).ask_async(), 0.01)
+            return result, len(beats)
+        result, beat_count = asyncio.run(main())
+        os.close(write_fd)
+    assert result == 'b'
+    assert beat_count > 1
+
+def test_prompt_defaults(monkeypatch):
+    reset_prompt_defaults()
+    set_prompt_defaults(hide_questionmark=True)
+    with pytest.raises(TypeError):
+        with prompt_defaults(allow_empty='x'):
+            pass
+    with prompt_defaults(allow_empty=True):
+        assert compile_prompt('A').formatted_prompt == 'A '
+        set_prompt_defaults(hide_questionmark='_None_')
+        assert compile_prompt('A').formatted_prompt == 'A? '
+        reset_prompt_defaults()
+        assert compile_prompt('A').formatted_prompt == 'A?* '
+    assert compile_prompt('A').formatted_prompt == 'A* '
+
+def test_prompt_defaults_per_task():
+    reset_prompt_defaults()
+    async def ask(name):
+        with prompt_defaults(default=name, no_interaction=True):
+            await asyncio.sleep(0.001)
+            with prompt_defaults(hide_mandatory_sign=True):
+                await asyncio.sleep(0.001)
+                return compile_prompt('Name').formatted_prompt
+    async def main():
+        return await asyncio.gather(*(ask(f'n{i}') for i in range(3)))
+    assert asyncio.run(main()) == ['Name? (n0) ', 'Name? (n1) ', 'Name? (n2) ']
+
+def test_prompt_io():
+    reset_prompt_defaults()
+    with pytest.raises(TypeError):
+        set_prompt_defaults(prompt_io=sys.stdout)
+    prompt_io = MemoryPromptIO('x\nb\n')
+    assert promptwithoptions('Pick', options=('a', 'b'), prompt_io=prompt_io, show_confirmation=True) == 'b'
+    assert prompt_io.getvalue() == '1 > a\n2 > b\nPick?* \x1b[F\x1b[KPick?* Pick: b\n'
+    with pytest.raises(EOFError):
+        promptwithoptions('Pick', options=('a', 'b'), prompt_io=prompt_io)
+
+def test_prompt_io_writes_once_per_render_cycle():
+    reset_prompt_defaults()
+    writes = list()
+    class Stream(io.StringIO):
+        def write(self, text):
+            writes.append(text)
+    prompt_io = PromptIO(io.StringIO('c\n\na\n'), Stream())
+    with prompt_defaults(prompt_io=prompt_io):
+        assert promptwithoptions('Pick', options=[f'o{i}' for i in range(100)], default='o3') == 'o3'
+        assert promptwithoptions('Pick', options=('a', 'b')) == 'a'
+    assert len(writes) == 3
+    assert asyncio.run(compile_prompt('Pick', prompt_io=MemoryPromptIO('b\n')).ask_async()) == 'b'
+
+def test_on_metrics(tmp_path):
+    reset_prompt_defaults()
+    with pytest.raises(TypeError):
+        compile_prompt('Pick', on_metrics=1)
+    reported = list()
+    prompt_io = MemoryPromptIO('x\nb\n')
+    assert promptwithoptions('Pick', options=('a', 'b'), prompt_io=prompt_io, on_metrics=reported.append) == 'b'
+    metrics, = reported
+    assert (metrics.prompt, metrics.retries, metrics.option_count, metrics.answered) == ('Pick', 1, 2, True)
+    assert metrics.bytes_written == len(prompt_io.getvalue())
+    assert all(metrics.as_dict()[name] >= 0 for name in ('resolve_time', 'validate_time', 'render_time', 'wait_time', 'parse_time'))
+    path = tmp_path / 'metrics.jsonl'
+    spec = compile_prompt('Name', prompt_io=MemoryPromptIO('a\n'), on_metrics=JsonLinesMetricsExporter(str(path)))
+    assert spec.ask() == 'a'
+    with pytest.raises(EOFError):
+        spec.ask()
+    first, second = (json.loads(line) for line in path.read_text().splitlines())
+    assert first['answered'] is True and second['answered'] is False
+    assert second['validate_time'] == 0.0
+
+def test_split_matches_shlex():
+    import shlex
+    def shlex_split(the_string):
+        try:
+            splitter = shlex.shlex(the_string, posix=True)
+            splitter.whitespace = ','
+            splitter.whitespace_split = True
+            return tuple(s.strip() for s in splitter)
+        except ValueError:
+            return None
+    for the_string in (
+        '', ',', 'a,,b', ' a , b ', 'a b,c', '"a,b",c', "'a\\,b',c", 'a\\,b,c',
+        '"a\\"b"', '"a\\b"', '"",b', "'',''", 'a#b,c\nd,e', '#x', 'a"b,c"d',
+        '"unclosed', "'unclosed", 'a\\', '"a\\', 'a,\n,b',
+    ):
+        assert split_escaped_comma_separated_string(the_string) == shlex_split(the_string), the_string
+
+def test_repetitive_bool_answers(monkeypatch):
+    reset_prompt_defaults()
+    feed_input(monkeypatch, 'y,n,yes', 'y,n')
+    assert promptwithoptions('Flags', data_type=bool, allow_multiple=True) == ('Y', 'N')
+
+def test_answer_history(tmp_path):
+    reset_prompt_defaults()
+    path = str(tmp_path / 'history.jsonl')
+    history = AnswerHistory(path, max_entries=2)
+    options = ('a', 'b', 'c')
+    assert promptwithoptions('Pick', options=options, history=history, prompt_io=MemoryPromptIO('b\n')) == 'b'
+    assert promptwithoptions('Picks', options=options, allow_multiple=True, history=history, prompt_io=MemoryPromptIO('a,c\n')) == ('a', 'c')
+    history = AnswerHistory(path, max_entries=2)
+    assert compile_prompt('Pick', options=options, history=history).default == 'b'
+    assert promptwithoptions('Picks', options=options, allow_multiple=True, history=history, prompt_io=MemoryPromptIO('\n')) == ('a', 'c')
+    # other options, other fingerprint
+    assert compile_prompt('Pick', options=('a', 'b'), history=history).default is None
+    assert compile_prompt('Pick', options=options, default='c', history=history).default == 'c'
+    run_form([compile_prompt('Name', history=history)], {'Name': 'x'})
+    history = AnswerHistory(path, max_entries=2)
+    assert len(history) == 2
+    assert compile_prompt('Pick', options=options, history=history).default is None
+    assert compile_prompt('Name', history=history).default == 'x'
+    with pytest.raises(TypeError):
+        compile_prompt('Name', history=path)
+
+def test_render_cache():
+    reset_prompt_defaults()
+    pwo_module.RENDER_CACHE.clear()
+    options = [f'o{i}' for i in range(50)]
+    first = compile_prompt('Pick', options=options, default='o1')
+    second = compile_prompt('Pick', options=list(options), default='o1')
+    assert first.formatted_options is None and len(pwo_module.RENDER_CACHE) == 1
+    assert first.answer('o3', quiet=True) == 'o3' and first.formatted_options is None
+    assert second.get_formatted_options() is first.get_formatted_options()
+    assert second.formatted_prompt is first.formatted_prompt
+    assert len(pwo_module.RENDER_CACHE) == 2
+    # keys are digests of the options, not the options themselves
+    assert all(first.options.fingerprint() in key for key in pwo_module.RENDER_CACHE.entries)
+    assert CompactOptionSet(options).cache_key() == CompactOptionSet(list(options)).cache_key() != CompactOptionSet(options[1:]).cache_key()
+    assert compile_prompt('Pick', options=options, default='o2').formatted_prompt == 'Pick?* (o2) '
+    assert compile_prompt('Pick', options=options + ['x'], default='o1').get_formatted_options().endswith('51 > x')
+    assert compile_prompt('Value', default=1).formatted_prompt == 'Value?* (1) '
+    assert compile_prompt('Value', default=True).formatted_prompt == 'Value?* (True) '
+    paged = compile_prompt('Pick', options=options, page_size=10)
+    assert paged.format_page(1) is paged.format_page(1)
+    cache = pwo_module.RenderCache(max_entries=2, max_chars=10)
+    assert cache.get('a', lambda: 'x' * 6) == 'xxxxxx'
+    assert cache.get('b', lambda: 'y' * 6) == 'yyyyyy'
+    assert cache.get('c', lambda: 'z' * 11) == 'z' * 11
+    assert list(cache.entries) == ['b']
+
+@pytest.mark.parametrize('option_validation', ['eager', 'threads', 'processes'])
+def test_option_validation_pool(monkeypatch, option_validation):
+    reset_prompt_defaults()
+    monkeypatch.setattr(pwo_module, 'VALIDATION_CHUNK_SIZE', 3)
+    monkeypatch.setattr(pwo_module, 'CONVERTED_VALUES', weakref.WeakKeyDictionary())
+    options = [str(i) for i in range(10)]
+    assert compile_prompt('Number', options=options, data_type=int, option_validation=option_validation).options is not None
+    assert pwo_module.CONVERTED_VALUES[int] == {str(i): i for i in range(10)}
+    with pytest.raises(TypeError, match='data_type validation failed: x, y'):
+        compile_prompt('Number', options=options + ['x', 'y'], data_type=int, option_validation=option_validation)
+    if option_validation == 'processes':
+        with pytest.raises(TypeError, match='data_type: picklable callable expected'):
+            compile_prompt('Number', options=options[:1], data_type=lambda value: int(value), option_validation=option_validation)
+    # the values converted by a data_type go with it
+    for _ in range(10):
+        assert pwo_module.find_invalid_options(OptionSet(options), lambda value: int(value)) == []
+    gc.collect()
+    assert list(pwo_module.CONVERTED_VALUES) == [int]
+
+def test_option_validation_lazy(monkeypatch):
+    reset_prompt_defaults()
+    monkeypatch.setattr(pwo_module, 'CONVERTED_VALUES', weakref.WeakKeyDictionary())
+    calls = list()
+    def data_type(value):
+        calls.append(value)
+        return int(value)
+    options = ['10', 'x', '30']
+    spec = compile_prompt('Number', options=options, data_type=data_type, option_validation='lazy')
+    assert calls == []
+    spec.prompt_io = MemoryPromptIO('x\n30\n')
+    assert spec.ask() == '30'
+    assert calls == ['x', '30']
+    with pytest.raises(TypeError):
+        compile_prompt('Number', options=options, data_type=data_type, default='x', option_validation='lazy')
+    # converted values are reused, failures are not remembered
+    compile_prompt('Number', options=options[::2], data_type=data_type)
+    assert calls == ['x', '30', 'x', '10']
+    with pytest.raises(TypeError):
+        compile_prompt('Number', option_validation='later')
+
+def test_return_converted(monkeypatch):
+    reset_prompt_defaults()
+    monkeypatch.setattr(pwo_module, 'CONVERTED_VALUES', weakref.WeakKeyDictionary())
+    calls = list()
+    def data_type(value):
+        calls.append(value)
+        return int(value)
+    assert promptwithoptions('Count', data_type=data_type, return_converted=True, prompt_io=MemoryPromptIO('x\n12\n')) == 12
+    # typed answers and defaults are converted afresh, options once
+    assert calls == ['x', '12', '12']
+    assert promptwithoptions('Counts', data_type=data_type, default='3,4', allow_multiple=True, return_converted=True, prompt_io=MemoryPromptIO('\n')) == (3, 4)
+    assert calls == ['x', '12', '12', '3', '4', '3', '4']
+    options = {'10': 'ten', '20': 'twenty'}
+    assert promptwithoptions('Pick', options=options, data_type=data_type, allow_multiple=True, return_converted=True, prompt_io=MemoryPromptIO('twenty,1\n')) == (20, 10)
+    assert calls == ['x', '12', '12', '3', '4', '3', '4', '10', '20']
+    assert promptwithoptions('Pick', options=options, data_type=data_type, return_converted=True, prompt_io=MemoryPromptIO('1\n')) == 10
+    assert promptwithoptions('Count', data_type=data_type, prompt_io=MemoryPromptIO('12\n')) == '12'
+    assert calls == ['x', '12', '12', '3', '4', '3', '4', '10', '20', '12']
+    assert promptwithoptions('Flags', data_type=bool, allow_multiple=True, allow_repetitive=True, return_converted=True, prompt_io=MemoryPromptIO('y,n,yes\n')) == (True, False, True)
+    assert promptwithoptions('Count', data_type=int, allow_empty=True, return_converted=True, prompt_io=MemoryPromptIO('\n')) == ''
+    assert run_form([compile_prompt('Count', data_type=int, return_converted=True)], {'Count': '7'}, quiet=True) == {'Count': 7}
+    with pytest.raises(TypeError):
+        compile_prompt('Count', return_converted='yes')
+
+def test_timeout():
+    reset_prompt_defaults()
+    read_fd, write_fd = os.pipe()
+    try:
+        with os.fdopen(read_fd, 'r', closefd=False) as reader:
+            prompt_io = PromptIO(reader, io.StringIO())
+            with prompt_defaults(prompt_io=prompt_io, timeout=0.05):
+                assert promptwithoptions('Pick', options=('a', 'b'), default='b') == 'b'
+                os.write(write_fd, b'a')
+                with pytest.raises(TimeoutError, match='Pick: no answer within 0.05 seconds'):
+                    promptwithoptions('Pick', options=('a', 'b'))
+                # the partial answer was dropped
+                os.write(write_fd, b'b\n')
+                assert promptwithoptions('Pick', options=('a', 'b')) == 'b'
+                os.write(write_fd, b'x\n')
+                assert promptwithoptions('Pick', options=('a', 'b'), default='a') == 'a'
+                assert prompt_io.writer.stream.getvalue().endswith('Pick?* (a) \x1b[F\x1b[KPick?* (a) a\n')
+                assert asyncio.run(compile_prompt('Pick', options=('a', 'b'), default='b').ask_async()) == 'b'
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+    with pytest.raises(TypeError):
+        compile_prompt('Pick', timeout=0)
+
+def test_reads_share_one_buffer(monkeypatch):
+    reset_prompt_defaults()
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'a\nb\r\nc\nd\nbob\nus\nend\ne\nf\ng\n')
+    os.close(write_fd)
+    with os.fdopen(read_fd) as stdin:
+        monkeypatch.setattr('sys.stdin', stdin)
+        assert promptwithoptions('A', timeout=5) == 'a'
+        assert promptwithoptions('B') == 'b'
+        assert promptwithoptions('C', timeout=5) == 'c'
+        assert asyncio.run(async_promptwithoptions('D')) == 'd'
+        # the script's own reads in between
+        assert input() == 'bob'
+        assert promptwithoptions('Zone', options=('eu', 'us')) == 'us'
+        assert input() == 'end'
+        assert promptwithoptions('E', timeout=5) == 'e'
+        assert sys.stdin.readline() == 'f\n'
+        assert promptwithoptions('G', prompt_io=PromptIO(writer=io.StringIO())) == 'g'
+        with pytest.raises(EOFError):
+            promptwithoptions('H')
+
+def test_session_record_and_replay(tmp_path):
+    reset_prompt_defaults()
+    path = str(tmp_path / 'session.jsonl')
+    options = [f'o{i}' for i in range(30)]
+    with SessionRecorder(path) as recorder:
+        with prompt_defaults(session_log=recorder):
+            assert promptwithoptions('Pick', options=options, page_size=10, prompt_io=MemoryPromptIO('>\nx\n12\n')) == 'o11'
+            assert promptwithoptions('Picks', options=options, allow_multiple=True, default='o1', prompt_io=MemoryPromptIO('\n')) == ('o1',)
+            assert promptwithoptions('Count', data_type=int, prompt_io=MemoryPromptIO('7\n')) == '7'
+    replayer = SessionReplayer(path)
+    assert len(replayer) == 3
+    prompt_io = MemoryPromptIO()
+    with prompt_defaults(session_log=replayer, prompt_io=prompt_io):
+        assert promptwithoptions('Pick', options=options, page_size=10) == 'o11'
+        assert promptwithoptions('Picks', options=options, allow_multiple=True, default='o1') == ('o1',)
+        assert promptwithoptions('Count', data_type=int, return_converted=True) == 7
+        assert replayer.exhausted and replayer.drift == []
+        prompt_io.reader = io.StringIO('3\n')
+        assert promptwithoptions('Extra', options=options) == 'o2'
+    assert prompt_io.getvalue().startswith('1 > o0')
+    replayer = SessionReplayer(path)
+    with prompt_defaults(session_log=replayer, prompt_io=MemoryPromptIO()):
+        assert promptwithoptions('Pick', options=options[1:], page_size=10) == 'o12'
+        assert replayer.drift == ["#1 Pick: options changed", "#1 Pick: answer is 'o12', recorded 'o11'"]
+        assert promptwithoptions('Picks', options=options, allow_multiple=True, default='o2') == ('o2',)
+        assert replayer.drift[2:] == ["#2 Picks: default was 'o1'", "#2 Picks: answer is ('o2',), recorded ['o1']"]
+        with pytest.raises(ValueError):
+            promptwithoptions('Count', data_type=float, options=('1', '2'))
+    replayer = SessionReplayer(path, strict=True)
+    with pytest.raises(ValueError, match="#1 Pick\\?: prompt was 'Pick'"):
+        promptwithoptions('Pick?', options=options, page_size=10, session_log=replayer)
+    with pytest.raises(TypeError):
+        compile_prompt('Pick', session_log=path)
+    zone_path = str(tmp_path / 'zone.jsonl')
+    with SessionRecorder(zone_path) as recorder:
+        assert promptwithoptions('Zone', options=('a', 'b'), default='b', no_interaction=True, session_log=recorder, prompt_io=MemoryPromptIO()) == 'b'
+    replayer = SessionReplayer(zone_path, strict=True)
+    assert promptwithoptions('Zone', options=('a', 'b'), default='b', no_interaction=True, session_log=replayer) == 'b'
+    assert replayer.exhausted
+
+
+def test_cli_coprocess():
+    requests = '{"id": 1, "prompt": "A", "options": [["x", "ex"], "y"]}\n\nnot json\n{"prompt": "B", "prompt_io": 1}\n{"id": 2, "prompt": "N", "data_type": "int", "allow_multiple": true, "return_converted": true}\n{"id": 3, "prompt": "C"}\n'
+    writer = io.StringIO()
+    serve_requests(io.StringIO(requests), writer, MemoryPromptIO('ex\n4,2\n'))
+    responses = [json.loads(line) for line in writer.getvalue().splitlines()]
+    assert responses[0] == {'answer': 'x', 'id': 1}
+    assert responses[1]['type'] == 'ValueError' and responses[1]['id'] is None
+    assert responses[2] == {'error': 'prompt_io: unknown argument', 'type': 'TypeError', 'id': None}
+    assert responses[3:] == [{'answer': [4, 2], 'id': 2}, {'error': 'end of input', 'type': 'EOFError', 'id': 3}]
+    with pytest.raises(TypeError):
+        load_request({'prompt': 'A', 'data_type': 'list'})
+
+
+def test_cli_one_shot(capsys):
+    pty = pytest.importorskip('pty')
+    master, slave = pty.openpty()
+    tty = os.ttyname(slave)
+    os.write(master, b'2\n')
+    assert cli_main(['Colour', '--options', 'red,"blue, dark"', '--default', 'red', '--tty', tty]) == 0
+    os.write(master, b'\n')
+    assert cli_main(['--json', '{"prompt": "Colour", "options": ["r", "b"], "allow_multiple": true}', '--default', 'r,b', '--tty', tty]) == 0
+    assert capsys.readouterr().out == 'blue, dark\nr\nb\n'
+    os.write(master, b'y\n')
+    assert cli_main(['Sure', '--data-type', 'bool', '--json-output', '--tty', tty]) == 0
+    assert capsys.readouterr().out == '"Y"\n'
+    if pwo_module.readline is not None:
+        # line editing on the terminal: 'l' typed two characters back
+        os.write(master, b'bue\x1b[D\x1b[Dl\n')
+        assert cli_main(['Colour', '--options', 'red,blue', '--tty', tty]) == 0
+        assert capsys.readouterr().out == 'blue\n'
+    with pytest.raises(SystemExit):
+        cli_main(['Colour', '--options', 'red', '--default', 'green', '--tty', tty])
+    with pytest.raises(SystemExit):
+        cli_main(['Colour', '--options', '"red', '--tty', tty])
+    with pytest.raises(SystemExit):
+        cli_main(['Colour', '--allow-multiple', '--default', '"a', '--tty', tty])
+    assert capsys.readouterr().err.count('unbalanced quotes') == 2
+    os.close(master)
+    os.close(slave)
@@ -0,0 +1,47 @@
+import asyncio
+
+from promptwithoptions import set_prompt_defaults, reset_prompt_defaults, compile_prompt
+from promptwithoptions.server import serve, open_connection
+
+
+async def read_until(reader, marker):
+    data = b''
+    while marker not in data:
+        chunk = await reader.read(4096)
+        assert chunk
+        data += chunk
+    return data.decode()
+
+
+def test_serve_sessions(tmp_path):
+    reset_prompt_defaults()
+    path = str(tmp_path / 'prompt.sock')
+    results = dict()
+
+    async def handler(session):
+        name = await session.ask('Name')
+        set_prompt_defaults(hide_questionmark=True)
+        results[name] = await session.ask('Zone', options=('eu', 'us'), show_confirmation=True)
+
+    async def client(name, zone):
+        reader, writer = await open_connection(path=path)
+        await read_until(reader, b'Name?* ')
+        writer.write(f'{name}\n'.encode())
+        assert await read_until(reader, b'Zone* ') == '1 > eu\n2 > us\nZone* '
+        writer.write(b'x\n')
+        await read_until(reader, b'Zone* ')
+        writer.write(f'{zone}\n'.encode())
+        output = (await reader.read()).decode()
+        writer.close()
+        return output
+
+    async def main():
+        server = await serve(handler, path=path)
+        outputs = await asyncio.gather(client('a', 'eu'), client('b', '2'), client('c', 'us'))
+        server.close()
+        await server.wait_closed()
+        return outputs
+
+    assert asyncio.run(main()) == ['Zone eu\n', 'Zone us\n', 'Zone us\n']
+    assert results == {'a': 'eu', 'b': 'us', 'c': 'us'}
+    assert compile_prompt('Zone').formatted_prompt == 'Zone?* '